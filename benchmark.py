@@ -0,0 +1,161 @@
+"""This script benchmarks a full migration by the ADH Stream Type Change Python sample against the local fake ADH service.
+The fake is hosted by this process, and each namespace size is migrated in its own child process, so that the reported peak memory belongs to that migration alone"""
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_adh import FakeADH
+from program import main
+
+# The namespace sizes that are benchmarked unless others are given on the command line
+default_stream_counts = [1000, 10000, 100000]
+
+def percentile(values, percent):
+    """Returns the given percentile of a list of values, using the nearest-rank method"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None where the resource module is not available (such as Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is reported in bytes on macOS, and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def parse_setting(setting):
+    """Parses a Key=Value command line setting, where the value is read as JSON if possible"""
+    key, _, value = setting.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def run_single(args):
+    """Runs a full migration with the appsettings written by run_all, against the fake ADH service hosted by the parent process, and returns the measurements of this process.
+    As the fake lives in the parent, the peak memory reported is that of the sample alone"""
+    with open(args.single) as f:
+        appsettings = json.load(f)
+
+    # Keep the per-stream console output and log messages of the sample out of the measurements
+    logging.getLogger().addHandler(logging.NullHandler())
+    error = None
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            main(True, appsettings)
+        except Exception as sample_error:
+            error = str(sample_error)
+    elapsed = time.perf_counter() - start
+
+    # The sample measures each call on the client side as well, which includes the time spent in the HTTP stack
+    client_metrics = {}
+    if os.path.exists(appsettings['MetricsFile']):
+        with open(appsettings['MetricsFile']) as f:
+            client_metrics = json.load(f)['Calls']
+
+    return {
+        'Seconds': round(elapsed, 3),
+        'PeakRssMB': peak_rss_mb(),
+        'Error': error,
+        'ClientCalls': client_metrics
+    }
+
+def run_benchmark(args, stream_count):
+    """Seeds the fake ADH service with a namespace of the given size, runs a full migration against it in a child process, and returns the measurements.
+    The fake is hosted by this process, so its in-memory namespace and call statistics do not count towards the peak memory of the migration"""
+    namespace_id = 'benchmark'
+
+    with FakeADH(latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                 throttle_rate=args.throttle_rate, max_in_flight=args.max_in_flight, seed=0) as fake, tempfile.TemporaryDirectory() as working_directory:
+
+        fake.seed_adapter_namespace(namespace_id, stream_count)
+
+        appsettings = fake.appsettings(namespace_id,
+                                       JournalFile=os.path.join(working_directory, 'journal.jsonl'),
+                                       StreamViewCacheFile=os.path.join(working_directory, 'stream_view_cache.json'),
+                                       MetricsFile=os.path.join(working_directory, 'metrics.json'),
+                                       FailedStreamsFile=os.path.join(working_directory, 'failed_streams.jsonl'))
+        appsettings.update(dict(parse_setting(setting) for setting in args.setting))
+
+        appsettings_file = os.path.join(working_directory, 'appsettings.json')
+        with open(appsettings_file, 'w') as f:
+            json.dump(appsettings, f)
+
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', appsettings_file], capture_output=True, text=True, check=True)
+        measurements = json.loads(completed.stdout.strip().splitlines()[-1])
+
+        converted = sum(1 for stream in fake.namespaces[namespace_id]['Streams'].values() if stream['TypeId'].endswith('Quality'))
+
+        return {
+            'Streams': stream_count,
+            'Converted': converted,
+            'Seconds': measurements['Seconds'],
+            'StreamsPerSecond': round(converted / measurements['Seconds'], 1),
+            'PeakRssMB': measurements['PeakRssMB'],
+            'Error': measurements['Error'],
+            'Calls': {
+                operation: {
+                    'Count': len(latencies),
+                    'Statuses': dict(fake.call_statuses[operation]),
+                    'P50ms': round(percentile(latencies, 50) * 1000, 2),
+                    'P99ms': round(percentile(latencies, 99) * 1000, 2)
+                }
+                for operation, latencies in fake.call_latencies.items()
+            },
+            'ClientCalls': measurements['ClientCalls']
+        }
+
+def run_all(args):
+    """Runs each namespace size in a separate process, and prints a summary table of the results"""
+    results = []
+    for stream_count in args.streams:
+        print(f'Benchmarking a migration of {stream_count} streams...')
+        results.append(run_benchmark(args, stream_count))
+
+    print()
+    print(f'{"Streams":>10} {"Seconds":>10} {"Streams/s":>10} {"Update p50 (ms)":>16} {"Update p99 (ms)":>16} {"Peak RSS (MB)":>14}')
+    for result in results:
+        update = result['Calls'].get('updateStreamType', {})
+        peak_rss = f'{result["PeakRssMB"]:.1f}' if result['PeakRssMB'] is not None else 'n/a'
+        print(f'{result["Streams"]:>10} {result["Seconds"]:>10} {result["StreamsPerSecond"]:>10} {update.get("P50ms", "n/a"):>16} {update.get("P99ms", "n/a"):>16} {peak_rss:>14}')
+        if result['Error']:
+            print(f'{"":>10} Error reported by the sample: {result["Error"]}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print()
+        print(f'Detailed results written to {args.output}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Stream Type change sample against a local fake ADH service')
+    parser.add_argument('--streams', type=int, nargs='+', default=default_stream_counts, help='namespace sizes to benchmark')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to every call by the fake service')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='up to this many seconds are randomly added to every call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls failed with a 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls failed with a 429')
+    parser.add_argument('--max-in-flight', type=int, help='calls arriving while this many calls are in flight are throttled with a 429')
+    parser.add_argument('--setting', action='append', default=[], metavar='KEY=VALUE', help='override an appsetting of the sample, such as MaxConcurrency=16')
+    parser.add_argument('--output', help='file to write the detailed results to as JSON')
+    parser.add_argument('--single', metavar='APPSETTINGS_FILE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_single(args)))
+    else:
+        run_all(args)
@@ -0,0 +1,409 @@
+"""An in-process stand-in for the ADH Types, Streams, and Stream Views REST endpoints used by the Stream Type change sample.
+This allows the sample to be tested and benchmarked locally, without a CONNECT data services namespace"""
+
+import fnmatch
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# The data types used when seeding a namespace with PI Adapter version 1.1 streams
+default_data_types = ['Double', 'Float', 'Int16', 'Int32', 'Int64', 'UInt16', 'UInt32', 'Boolean', 'String', 'DateTime']
+
+# Routes of the ADH REST API that are served by the fake, along with the name of the sample library function that calls each one
+routes = [
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces$'), 'getNamespaces'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Types$'), 'getTypes'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Types/(?P<id>[^/]+)$'), 'getType'),
+    ('POST', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Types/(?P<id>[^/]+)$'), 'getOrCreateType'),
+    ('DELETE', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Types/(?P<id>[^/]+)$'), 'deleteType'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Streams$'), 'getStreams'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Streams/(?P<id>[^/]+)$'), 'getStream'),
+    ('POST', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Streams/(?P<id>[^/]+)$'), 'getOrCreateStream'),
+    ('DELETE', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Streams/(?P<id>[^/]+)$'), 'deleteStream'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Streams/(?P<id>[^/]+)/Type$'), 'getStreamType'),
+    ('PUT', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/Streams/(?P<id>[^/]+)/Type$'), 'updateStreamType'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/StreamViews$'), 'getStreamViews'),
+    ('GET', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/StreamViews/(?P<id>[^/]+)$'), 'getStreamView'),
+    ('POST', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/StreamViews/(?P<id>[^/]+)$'), 'getOrCreateStreamView'),
+    ('DELETE', re.compile(r'^/api/[^/]+/Tenants/[^/]+/Namespaces/(?P<namespace_id>[^/]+)/StreamViews/(?P<id>[^/]+)$'), 'deleteStreamView'),
+]
+
+
+class FakeSdsError(Exception):
+    """An error to be returned to the client with the given HTTP status code"""
+
+    def __init__(self, status_code, reason, headers=None):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers or {}
+
+
+def compile_search(query):
+    """Compiles an SDS search query into a function that checks if an SDS object (as a dictionary) matches it.
+    Supports wildcards (*), AND, OR, NOT, parentheses, and field qualifiers such as TypeId:TimeIndexed.Double.
+    Unqualified terms are matched against the Id and Name of the object"""
+
+    tokens = re.findall(r'\(|\)|[^\s()]+', query or '')
+    if not tokens:
+        return lambda item: True
+
+    position = 0
+
+    def peek():
+        return tokens[position].upper() if position < len(tokens) else None
+
+    def term():
+        nonlocal position
+        token = tokens[position]
+        position += 1
+
+        if token.upper() == 'NOT':
+            negated = term()
+            return lambda item: not negated(item)
+
+        if token == '(':
+            grouped = expression()
+            position += 1  # closing parenthesis
+            return grouped
+
+        field, separator, pattern = token.partition(':')
+        fields = [field] if separator else ['Id', 'Name']
+        pattern = re.compile(fnmatch.translate((pattern if separator else token).lower()))
+
+        def matches(item):
+            for value in (item.get(field) for field in fields):
+                if value is not None and pattern.match(str(value).lower()):
+                    return True
+            return False
+
+        return matches
+
+    def conjunction():
+        nonlocal position
+        terms = [term()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                position += 1
+            terms.append(term())
+        return lambda item: all(this_term(item) for this_term in terms)
+
+    def expression():
+        nonlocal position
+        conjunctions = [conjunction()]
+        while peek() == 'OR':
+            position += 1
+            conjunctions.append(conjunction())
+        return lambda item: any(this_conjunction(item) for this_conjunction in conjunctions)
+
+    return expression()
+
+
+class FakeADH:
+    """Serves an in-memory copy of the Types, Streams, and Stream Views of one or more namespaces over HTTP on localhost.
+    Each call can be given an artificial latency, and a fraction of calls can be failed or throttled to simulate a busy service.
+    A limit on the calls in flight can also be set, above which calls are throttled, to simulate a service with a fixed capacity"""
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, max_in_flight=None, lost_response_rate=0.0, seed=None):
+        """
+        :param latency: seconds added to every call
+        :param latency_jitter: up to this many seconds are randomly added on top of the latency
+        :param error_rate: fraction of calls that fail with a 503 Service Unavailable
+        :param throttle_rate: fraction of calls that fail with a 429 Too Many Requests
+        :param retry_after: seconds returned in the Retry-After header of throttled calls
+        :param max_in_flight: calls arriving while this many calls are already being served fail with a 429 Too Many Requests
+        :param lost_response_rate: fraction of calls that are carried out, but fail with a 504 Gateway Timeout as if the response was lost on its way back
+        :param seed: seed of the random number generator, for repeatable runs
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_in_flight = max_in_flight
+        self.lost_response_rate = lost_response_rate
+
+        self.tenant_id = 'fake-tenant'
+        self.namespaces = defaultdict(lambda: {'Types': {}, 'Streams': {}, 'StreamViews': {}})
+
+        # Server side durations of each call, and the number of calls by response status code, keyed by sample library function name
+        self.call_latencies = defaultdict(list)
+        self.call_statuses = defaultdict(lambda: defaultdict(int))
+
+        # The Ids matching each search query, so that paging through a large collection does not rescan it for every page
+        self.__search_results = {}
+
+        self.__random = random.Random(seed)
+        self.__in_flight = 0
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def url(self):
+        """The base URL of the fake, to be used as the Resource of the ADH client"""
+        host, port = self.__server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Starts serving requests on a background thread"""
+        fake = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            """Dispatches each request to the fake"""
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def do_PUT(self):
+                fake._handle(self)
+
+            def do_DELETE(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving requests"""
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def appsettings(self, namespace_id, **overrides):
+        """Returns the appsettings for running the sample against a namespace of the fake, with any overrides applied"""
+        appsettings = {
+            'Resource': self.url,
+            'ApiVersion': 'v1',
+            'TenantId': self.tenant_id,
+            'NamespaceId': namespace_id,
+            'ClientId': None,
+            'ClientSecret': None,
+            'AdapterType': 'OpcUa',
+            'StreamSearchPattern': '*'
+        }
+        appsettings.update(overrides)
+        return appsettings
+
+    # Seeding
+
+    def add_type(self, namespace_id, type_id, properties=None):
+        """Adds an SDS Type to the namespace"""
+        self.namespaces[namespace_id]['Types'][type_id] = {'Id': type_id, 'Name': type_id, 'SdsTypeCode': 'Object', 'Properties': properties or []}
+        self.__invalidate_searches(namespace_id, 'Types')
+
+    def add_stream(self, namespace_id, stream_id, type_id, name=None):
+        """Adds a stream of the given SDS Type to the namespace"""
+        self.namespaces[namespace_id]['Streams'][stream_id] = {'Id': stream_id, 'Name': name or stream_id, 'TypeId': type_id}
+        self.__invalidate_searches(namespace_id, 'Streams')
+
+    def seed_adapter_namespace(self, namespace_id, stream_count, adapter_type='OpcUa', data_types=None, stream_id_template='{adapter_type}.{i}'):
+        """Sets up a namespace as it looks after a PI Adapter was upgraded from version 1.1 to 1.2:
+        both the TimeIndexed.<data_type> and TimeIndexed.<data_type>.<adapter_type>Quality types exist,
+        and the given number of streams are spread evenly across the version 1.1 types"""
+        data_types = data_types or default_data_types
+
+        for data_type in data_types:
+            self.add_type(namespace_id, f'TimeIndexed.{data_type}')
+            self.add_type(namespace_id, f'TimeIndexed.{data_type}.{adapter_type}Quality')
+
+        for i in range(stream_count):
+            self.add_stream(namespace_id, stream_id_template.format(adapter_type=adapter_type, i=i), f'TimeIndexed.{data_types[i % len(data_types)]}')
+
+    # Request handling
+
+    def _handle(self, request):
+        """Serves one HTTP request, applying the configured latency, errors, and throttling"""
+        start = time.perf_counter()
+        url = urlparse(request.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length)) if length > 0 else None
+
+        operation = 'unknown'
+        headers = {}
+        try:
+            for method, pattern, name in routes:
+                match = pattern.match(url.path)
+                if match and method == request.command:
+                    operation = name
+                    break
+            else:
+                raise FakeSdsError(404, f'No route for {request.command} {url.path}')
+
+            # A call over capacity is turned away straight away, without counting towards the calls in flight
+            with self.__lock:
+                if self.max_in_flight is not None and self.__in_flight >= self.max_in_flight:
+                    raise FakeSdsError(429, 'Too many requests', {'Retry-After': str(self.retry_after)})
+                self.__in_flight += 1
+
+            try:
+                delay = self.latency + (self.__random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+                if delay > 0:
+                    time.sleep(delay)
+            finally:
+                with self.__lock:
+                    self.__in_flight -= 1
+
+            with self.__lock:
+                roll = self.__random.random()
+            if roll < self.throttle_rate:
+                raise FakeSdsError(429, 'Too many requests', {'Retry-After': str(self.retry_after)})
+            if roll < self.throttle_rate + self.error_rate:
+                raise FakeSdsError(503, 'Service unavailable')
+
+            arguments = {key: unquote(value) for key, value in match.groupdict().items()}
+            status, content = getattr(self, f'_{operation}')(params=params, body=body, **arguments)
+
+            if self.lost_response_rate:
+                with self.__lock:
+                    roll = self.__random.random()
+                if roll < self.lost_response_rate:
+                    raise FakeSdsError(504, 'Gateway timeout')
+
+        except FakeSdsError as error:
+            status = error.status_code
+            content = {'Error': error.reason, 'Reason': error.reason, 'Resolution': 'This error was generated by the fake ADH service.'}
+            headers = error.headers
+
+        payload = json.dumps(content).encode('utf-8') if content is not None else b''
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        for header, value in headers.items():
+            request.send_header(header, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+        with self.__lock:
+            self.call_latencies[operation].append(time.perf_counter() - start)
+            self.call_statuses[operation][status] += 1
+
+    def __collection(self, namespace_id, collection):
+        return self.namespaces[namespace_id][collection]
+
+    def __invalidate_searches(self, namespace_id, collection, field_queries_only=False):
+        """Forgets the cached search results of a collection after it changes.
+        When only a field other than the Id or Name changed, just the queries qualified by a field are affected"""
+        for key in [key for key in self.__search_results if key[:2] == (namespace_id, collection)]:
+            if not field_queries_only or ':' in key[2]:
+                del self.__search_results[key]
+
+    def __search(self, namespace_id, collection, params):
+        """Pages through the objects of a collection matching the query, in creation order"""
+        skip = int(params.get('skip', 0))
+        count = int(params.get('count', 100))
+        query = params.get('query', '')
+        key = (namespace_id, collection, query)
+
+        with self.__lock:
+            items = self.__collection(namespace_id, collection)
+            if key not in self.__search_results:
+                matches = compile_search(query)
+                self.__search_results[key] = [id for id, item in items.items() if matches(item)]
+
+            return 200, [items[id] for id in self.__search_results[key][skip:skip + count] if id in items]
+
+    def __get(self, namespace_id, collection, id):
+        item = self.__collection(namespace_id, collection).get(id)
+        if item is None:
+            raise FakeSdsError(404, f'{id} was not found in {collection}')
+        return 200, item
+
+    def __get_or_create(self, namespace_id, collection, id, body):
+        with self.__lock:
+            items = self.__collection(namespace_id, collection)
+            if id in items:
+                return 200, items[id]
+            items[id] = body
+            self.__invalidate_searches(namespace_id, collection)
+            return 201, body
+
+    def __delete(self, namespace_id, collection, id):
+        with self.__lock:
+            if self.__collection(namespace_id, collection).pop(id, None) is None:
+                raise FakeSdsError(404, f'{id} was not found in {collection}')
+            self.__invalidate_searches(namespace_id, collection)
+        return 204, None
+
+    def _getNamespaces(self, params, body):
+        return 200, [{'Id': namespace_id, 'Region': 'fake', 'State': 'Active'} for namespace_id in list(self.namespaces)]
+
+    def _getTypes(self, namespace_id, params, body):
+        return self.__search(namespace_id, 'Types', params)
+
+    def _getType(self, namespace_id, id, params, body):
+        return self.__get(namespace_id, 'Types', id)
+
+    def _getOrCreateType(self, namespace_id, id, params, body):
+        return self.__get_or_create(namespace_id, 'Types', id, body)
+
+    def _deleteType(self, namespace_id, id, params, body):
+        return self.__delete(namespace_id, 'Types', id)
+
+    def _getStreams(self, namespace_id, params, body):
+        return self.__search(namespace_id, 'Streams', params)
+
+    def _getStream(self, namespace_id, id, params, body):
+        return self.__get(namespace_id, 'Streams', id)
+
+    def _getOrCreateStream(self, namespace_id, id, params, body):
+        return self.__get_or_create(namespace_id, 'Streams', id, body)
+
+    def _deleteStream(self, namespace_id, id, params, body):
+        return self.__delete(namespace_id, 'Streams', id)
+
+    def _getStreamType(self, namespace_id, id, params, body):
+        _, stream = self.__get(namespace_id, 'Streams', id)
+        return self.__get(namespace_id, 'Types', stream['TypeId'])
+
+    def _updateStreamType(self, namespace_id, id, params, body):
+        _, stream = self.__get(namespace_id, 'Streams', id)
+        stream_view = self.__collection(namespace_id, 'StreamViews').get(params.get('streamViewId'))
+
+        if stream_view is None:
+            raise FakeSdsError(400, f'Stream view {params.get("streamViewId")} was not found')
+        if stream_view['SourceTypeId'] != stream['TypeId']:
+            raise FakeSdsError(400, f'Stream view {stream_view["Id"]} does not have a source type of {stream["TypeId"]}')
+
+        with self.__lock:
+            stream['TypeId'] = stream_view['TargetTypeId']
+            self.__invalidate_searches(namespace_id, 'Streams', field_queries_only=True)
+        return 204, None
+
+    def _getStreamViews(self, namespace_id, params, body):
+        return self.__search(namespace_id, 'StreamViews', params)
+
+    def _getStreamView(self, namespace_id, id, params, body):
+        return self.__get(namespace_id, 'StreamViews', id)
+
+    def _getOrCreateStreamView(self, namespace_id, id, params, body):
+        for type_id in (body.get('SourceTypeId'), body.get('TargetTypeId')):
+            if type_id not in self.__collection(namespace_id, 'Types'):
+                raise FakeSdsError(400, f'Type {type_id} was not found')
+        return self.__get_or_create(namespace_id, 'StreamViews', id, body)
+
+    def _deleteStreamView(self, namespace_id, id, params, body):
+        return self.__delete(namespace_id, 'StreamViews', id)
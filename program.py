@@ -1,8 +1,109 @@
+import argparse
+import bisect
 import datetime
+import email.utils
+import functools
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
 import traceback
-from adh_sample_library_preview import (ADHClient, Types, Streams, StreamViews, SdsStreamView)
+import zlib
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
+from multiprocessing.util import Finalize
+import requests
+from requests.adapters import HTTPAdapter
+from adh_sample_library_preview import (ADHClient, BaseClient, Types, Streams, StreamViews, SdsStreamView)
+
+# The number of stream type updates that are sent to ADH at the same time, unless overridden by MaxConcurrency in appsettings.json
+default_max_concurrency = 8
+
+# The number of streams requested from ADH per page while enumerating, unless overridden by PageSize in appsettings.json
+default_page_size = 1000
+
+# The format of the log file entries
+log_format = '%(asctime)s %(module)16s,line: %(lineno)4d %(levelname)8s | %(message)s'
+log_date_format = '%Y-%m-%d %H:%M:%S'
+
+# The log records are written to the log file in batches of this many records, or after this many seconds if fewer records arrive
+log_batch_size = 1000
+log_flush_interval = 2.0
+
+# How often the progress of the stream conversions is shown on the console, unless overridden by ProgressIntervalSeconds in appsettings.json
+default_progress_interval = 5
+
+# The local file that records the outcome of each stream, unless overridden by JournalFile in appsettings.json
+default_journal_file = 'journal.jsonl'
+
+# The local file that caches the stream views generated for each namespace and adapter type, unless overridden by StreamViewCacheFile in appsettings.json
+default_stream_view_cache_file = 'stream_view_cache.json'
+
+# The local file that the JSON summary of the metrics is written to at exit, unless overridden by MetricsFile in appsettings.json
+default_metrics_file = 'metrics.json'
+
+# How often the Prometheus text file is refreshed when PrometheusFile is set in appsettings.json, unless overridden by PrometheusIntervalSeconds
+default_prometheus_interval = 15
+
+# The local file that the migration plan is written to by plan mode and read from by execute mode, unless overridden by PlanFile in appsettings.json
+default_plan_file = 'migration_plan.jsonl'
+
+# The number of stream ids written on each line of the migration plan
+plan_chunk_size = 1000
+
+# The local file that the verify mode writes its report to, unless overridden by VerificationReportFile in appsettings.json
+default_verification_report_file = 'verification_report.json'
+
+# How often, in seconds, the watch mode looks for new streams on the existing types, unless overridden by WatchIntervalSeconds in appsettings.json
+default_watch_interval = 60
+
+# How often, in seconds, the background thread checks whether the bearer token is close to expiring, unless overridden by TokenRefreshIntervalSeconds in appsettings.json.
+# The token is refreshed once it is within 5 minutes of expiring, so this must be well under that
+default_token_refresh_interval = 60
+
+# The cached bearer token is treated as expired this many seconds before it actually expires, so that it does not expire while a request is on its way
+token_expiry_margin = 30
+
+# A compact record of an enumerated stream, holding only the fields needed to convert it
+StreamRecord = namedtuple('StreamRecord', ['Id', 'TypeId'])
+
+# How many times a stream type update that failed with a transient error is retried, and the bounds of the exponential backoff between the retries,
+# unless overridden by MaxRetries, RetryBaseDelaySeconds, and RetryMaxDelaySeconds in appsettings.json
+RetryPolicy = namedtuple('RetryPolicy', ['MaxRetries', 'BaseDelaySeconds', 'MaxDelaySeconds'])
+default_retry_policy = RetryPolicy(5, 0.5, 30.0)
+
+# The HTTP status codes of the errors that are worth retrying
+transient_status_codes = {408, 429, 500, 502, 503, 504}
+
+# The adaptive concurrency limit is halved once the average latency exceeds this many times its baseline, when set with LatencyTolerance in appsettings.json.
+# By default only throttling and transient errors lower the limit
+default_latency_tolerance = None
+
+# The baseline latency of the adaptive concurrency limit is the lowest average latency over this many seconds, once the average has settled over this many calls
+latency_baseline_window = 10.0
+latency_warm_up_calls = 20
+
+# The share of the streams converted by this host when a migration is split across several hosts: shard Index (from 1) of Count,
+# set with --shard i/N on the command line or Shard in appsettings.json
+Shard = namedtuple('Shard', ['Index', 'Count'])
+
+# The local file that a shard writes its summary to, with the shard appended to its name (eg. shard_summary.2of4.json), and that the merge mode writes the
+# combined summary to, unless overridden by ShardSummaryFile in appsettings.json or --summary-file on the command line
+default_shard_summary_file = 'shard_summary.json'
+
+# The fields of a mapping rule that select the existing type ids it applies to. Each rule has exactly one of them
+mapping_rule_selectors = ('TypeId', 'Glob', 'Regex')
+
+# The local file that the streams which could not be converted are appended to, unless overridden by FailedStreamsFile in appsettings.json
+default_failed_streams_file = 'failed_streams.jsonl'
 
 def get_appsettings():
     """Open and parse the appsettings.json file"""
@@ -25,15 +126,1007 @@ def affirmative_response(response):
     affirmative_responses = ['y', 'yes']
     return response.lower() in affirmative_responses
 
+def confirm(test, prompt, message=None):
+    """Asks the user a yes or no question, after showing the message (if any), and returns whether the response is affirmative.
+    If this script is being E2E tested, the user input is presumed to be y without prompting"""
+    if test:
+        output(logging.DEBUG, f'Automated test will not prompt the user "{prompt}", assuming a response of y.')
+        return True
+
+    print()
+    if message is not None:
+        output(logging.INFO, message)
+        print()
+    logging.debug(f'Prompting user: {prompt}')
+    response = input(f'{prompt} (y/n): ')
+    logging.debug(f'Response: {response}')
+    print()
+    return affirmative_response(response)
+
 def output(level, message):
     """Prints the given message to the console as well as the log file, with the given log level"""
     logging.log(level, message)
     print(message)
 
-def generate_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, test):
-    """This function takes in an adapter type (such as 'OpcUa'), generates the necessary stream views,
-    and returns a mapping table for the existing type to the stream view that maps it to the new type.
-    This function is specific to the adapter version 1.1 to 1.2 upgrade use case"""
+def log_stream(level, message):
+    """Logs a message about a single stream to the log file only. The console shows the aggregated progress instead, see ApiMetrics.start_reporting_progress"""
+    logging.log(level, message)
+
+class BatchingHandler(MemoryHandler):
+    """Buffers log records and writes them to the target handler in batches: once the buffer is full, once flush_interval seconds have passed
+    since the last batch, or straight away for an error"""
+
+    def __init__(self, capacity, flush_interval, target):
+        super().__init__(capacity, flushLevel=logging.ERROR, target=target)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        super().flush()
+        self.last_flush = time.monotonic()
+
+class LogPipeline:
+    """Non-blocking logging pipeline. Logging calls only put the record on a queue, and a background thread writes the records to the log file in batches,
+    so that neither the main thread nor the conversion workers wait on the file. A second background thread writes out the batch every flush_interval seconds,
+    so the last records before a quiet spell do not wait for the next one. Replaces any handlers of the root logger"""
+
+    def __init__(self, log_file_name, level, batch_size=log_batch_size, flush_interval=log_flush_interval):
+        self.log_file_name = log_file_name
+        self.__file_handler = logging.FileHandler(log_file_name, encoding='utf-8')
+        self.__file_handler.setFormatter(logging.Formatter(log_format, log_date_format))
+        self.__batching_handler = BatchingHandler(batch_size, flush_interval, self.__file_handler)
+
+        log_queue = queue.SimpleQueue()
+        self.__listener = QueueListener(log_queue, self.__batching_handler)
+        self.__stopped = threading.Event()
+        self.__flusher = threading.Thread(target=self.__flush_periodically, name='LogFlusher', daemon=True)
+
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(QueueHandler(log_queue))
+        root_logger.setLevel(level)
+
+        self.__listener.start()
+        self.__flusher.start()
+
+    def __flush_periodically(self):
+        """Writes out the batch whenever flush_interval seconds have passed since the last one, even if no record has arrived since"""
+        flush_interval = self.__batching_handler.flush_interval
+        while not self.__stopped.wait(max(0, self.__batching_handler.last_flush + flush_interval - time.monotonic())):
+            if time.monotonic() - self.__batching_handler.last_flush >= flush_interval:
+                self.__batching_handler.flush()
+
+    def stop(self):
+        """Writes the records still queued or buffered to the log file, and stops the background threads"""
+        self.__stopped.set()
+        self.__flusher.join()
+        self.__listener.stop()
+        self.__batching_handler.close()
+        self.__file_handler.close()
+
+def raise_no_streams_found(namespace_id, stream_search_query):
+    """Logs and raises the error for a stream search pattern that did not match any streams"""
+    message = f'No stream found on namespace {namespace_id} that match the stream search pattern of {stream_search_query}'
+    output(logging.ERROR, message)
+    output(logging.ERROR, 'Quitting script...')
+    raise Exception(message)
+
+class StreamCatalog:
+    """A compact catalog of enumerated streams, grouped by their type. Only the stream ids are kept, in a list per type id,
+    with each type id interned so that it is stored once however many streams share it. A stream's name is only kept where it differs from its id.
+    This takes a small fraction of the memory of the SdsStream objects, and lets the mappings table be consulted once per type rather than once per stream"""
+
+    def __init__(self, streams=()):
+        self.__stream_ids = {}
+        self.__names = {}
+        self.__count = 0
+        self.extend(streams)
+
+    def add(self, stream):
+        """Adds a stream (an SdsStream or StreamRecord) to the catalog"""
+        stream_ids = self.__stream_ids.get(stream.TypeId)
+        if stream_ids is None:
+            stream_ids = self.__stream_ids[sys.intern(stream.TypeId)] = []
+        stream_ids.append(stream.Id)
+
+        name = getattr(stream, 'Name', None)
+        if name is not None and name != stream.Id:
+            self.__names[stream.Id] = name
+
+        self.__count += 1
+
+    def extend(self, streams):
+        """Adds each of the given streams to the catalog"""
+        for stream in streams:
+            self.add(stream)
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        return self.records()
+
+    def type_ids(self):
+        """Returns the type ids of the streams in the catalog, in the order they were first seen"""
+        return list(self.__stream_ids)
+
+    def stream_ids(self, type_id):
+        """Returns the ids of the streams of a type"""
+        return self.__stream_ids.get(type_id, [])
+
+    def counts(self):
+        """Returns the number of streams of each type"""
+        return {type_id: len(stream_ids) for type_id, stream_ids in self.__stream_ids.items()}
+
+    def name(self, stream_id):
+        """Returns the name of a stream"""
+        return self.__names.get(stream_id, stream_id)
+
+    def where(self, keep):
+        """Returns a new catalog of the streams whose id passes the given check"""
+        catalog = StreamCatalog()
+        for type_id, stream_ids in self.__stream_ids.items():
+            kept_stream_ids = [stream_id for stream_id in stream_ids if keep(stream_id)]
+            if kept_stream_ids:
+                catalog.__stream_ids[type_id] = kept_stream_ids
+                catalog.__count += len(kept_stream_ids)
+        catalog.__names = {stream_id: name for stream_id, name in self.__names.items() if keep(stream_id)}
+        return catalog
+
+    def records(self, type_ids=None):
+        """Generator of a StreamRecord for each stream of the given types (or of every type), one type after another.
+        The records of a type all share its interned type id"""
+        for type_id in self.__stream_ids if type_ids is None else type_ids:
+            for stream_id in self.__stream_ids.get(type_id, []):
+                yield StreamRecord(stream_id, type_id)
+
+def enumerate_streams(adh_client, namespace_id, query, page_size=default_page_size, compact=True, pages_in_flight=1):
+    """Generator that pages through the streams matching the query using skip and count, yielding each page as soon as it arrives.
+    While a page is being processed by the caller, the next pages_in_flight pages are already being requested in the background.
+    Requesting several pages at once is only safe while the results of the query do not change, as each page is requested at a fixed offset.
+    By default each stream is reduced to a StreamRecord, otherwise the full SdsStream objects are yielded"""
+
+    def get_page(skip):
+        """Requests one page of streams from ADH"""
+        return call_with_retries(lambda: adh_client.Streams.getStreams(namespace_id, query=query, skip=skip, count=page_size), f'the page of streams at {skip}')
+
+    with ThreadPoolExecutor(max_workers=pages_in_flight) as prefetcher:
+        next_pages = deque(prefetcher.submit(get_page, index * page_size) for index in range(pages_in_flight))
+        skip = pages_in_flight * page_size
+
+        while next_pages:
+            page = next_pages.popleft().result()
+
+            # A short page means the end of the search results has been reached, so the pages requested after it are not needed
+            if len(page) == page_size:
+                next_pages.append(prefetcher.submit(get_page, skip))
+                skip += page_size
+            else:
+                for next_page in next_pages:
+                    next_page.cancel()
+                next_pages.clear()
+
+            if len(page) > 0:
+                yield [StreamRecord(stream.Id, stream.TypeId) for stream in page] if compact else page
+
+def type_id_query(stream_search_query, type_ids):
+    """Narrows the stream search pattern to the streams whose type is one of the given type ids"""
+    type_query = ' OR '.join(f'TypeId:{type_id}' for type_id in type_ids)
+    return f'({stream_search_query}) AND ({type_query})' if stream_search_query else type_query
+
+def enumerate_streams_per_type(adh_client, namespace_id, stream_search_query, type_ids, page_size=default_page_size, max_concurrency=default_max_concurrency):
+    """Runs one query per type id, narrowing the stream search pattern to the streams of that type, and merges the results.
+    The queries are run concurrently, and each is paged through in full, so only the streams of the given types are transferred from ADH.
+    Returns the streams as a StreamCatalog"""
+
+    catalog = StreamCatalog()
+    catalog_lock = threading.Lock()
+
+    def add_streams_of_type(type_id):
+        """Pages through every stream of the type matching the stream search pattern, adding each stream to the catalog once"""
+        query = type_id_query(stream_search_query, [type_id])
+        seen_stream_ids = set()
+        for page in enumerate_streams(adh_client, namespace_id, query, page_size, compact=False):
+            new_streams = [stream for stream in page if stream.Id not in seen_stream_ids]
+            seen_stream_ids.update(stream.Id for stream in new_streams)
+            with catalog_lock:
+                catalog.extend(new_streams)
+
+    # A stream has a single type, so the streams of the different queries never overlap
+    if type_ids:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(type_ids))) as executor:
+            list(executor.map(add_streams_of_type, type_ids))
+
+    return catalog
+
+def count_skipped_streams(adh_client, namespace_id, stream_search_query, type_ids, page_size=default_page_size, shard=None):
+    """Counts the streams matching the stream search pattern whose type is not one of the given type ids, by type id.
+    These are the streams that are skipped when only the streams of the given types are queried. If a shard is given, only its streams are counted"""
+    query = f'({stream_search_query or "*"}) AND NOT ({type_id_query(None, type_ids)})'
+    return Counter(stream.TypeId for page in enumerate_streams(adh_client, namespace_id, query, page_size) for stream in page if in_shard(stream.Id, shard))
+
+class AdaptiveConcurrency:
+    """Additive increase, multiplicative decrease (AIMD) limit on the number of stream conversions in flight.
+    The limit grows by one after a full window of successful calls, and is halved when ADH throttles a call, fails it with a transient error,
+    or (if latency_tolerance is set) slows down to more than latency_tolerance times the baseline latency. The baseline is the lowest exponentially weighted
+    average latency over the last few seconds, rather than the fastest single call, so the ordinary spread of latencies does not lower the limit. As in TCP, it is halved at most once per window:
+    the calls that were already in flight when it was lowered cannot lower it again. A Retry-After on a throttled call pauses every worker until it has passed"""
+
+    def __init__(self, maximum, minimum=1, latency_tolerance=default_latency_tolerance):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.latency_tolerance = latency_tolerance
+        self.limit = maximum
+        self.lowest_limit = maximum
+        self.__successes = 0
+        self.__calls = 0
+        self.__average_latency = None
+        self.__baseline_latencies = deque()
+        self.__last_decrease = float('-inf')
+        self.__resume_time = 0.0
+        self.__lock = threading.Lock()
+
+    def record_success(self, started, seconds):
+        """Records the latency of a successful call started at the given time.monotonic, growing the limit after a full window of calls at a healthy latency"""
+        with self.__lock:
+            # An exponentially weighted average, so a single slow call does not halve the limit on its own
+            self.__average_latency = seconds if self.__average_latency is None else 0.9 * self.__average_latency + 0.1 * seconds
+            self.__calls += 1
+
+            if self.latency_tolerance is not None and self.__calls >= latency_warm_up_calls:
+                baseline = self.__update_baseline(self.__average_latency)
+                if self.__average_latency > self.latency_tolerance * baseline:
+                    self.__decrease(started, 'the latency rose')
+                    return
+
+            self.__successes += 1
+            if self.__successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.__successes = 0
+                logging.debug(f'Raised the concurrency limit to {self.limit}')
+
+    def record_throttled(self, started, retry_after=None):
+        """Records a throttled or transiently failed call started at the given time.monotonic, halving the limit and pausing new calls for the Retry-After duration (if any)"""
+        with self.__lock:
+            self.__decrease(started, 'ADH throttled a call')
+            if retry_after:
+                self.__resume_time = max(self.__resume_time, time.monotonic() + retry_after)
+
+    def __update_baseline(self, average_latency):
+        """Adds the current average latency to the window of recent averages, and returns the lowest of them. Must be called with the lock held.
+        The window is kept in increasing order of latency, so its lowest average is always at the front"""
+        now = time.monotonic()
+        while self.__baseline_latencies and self.__baseline_latencies[-1][1] >= average_latency:
+            self.__baseline_latencies.pop()
+        self.__baseline_latencies.append((now, average_latency))
+        while self.__baseline_latencies[0][0] < now - latency_baseline_window:
+            self.__baseline_latencies.popleft()
+        return self.__baseline_latencies[0][1]
+
+    def __decrease(self, started, reason):
+        """Halves the limit, unless the call was started before the last decrease. Must be called with the lock held"""
+        if started < self.__last_decrease:
+            return
+
+        self.limit = max(self.minimum, self.limit // 2)
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        self.__successes = 0
+        self.__last_decrease = time.monotonic()
+        logging.debug(f'Lowered the concurrency limit to {self.limit}, as {reason}')
+
+    def wait_until_resumed(self):
+        """Blocks until the pause requested by the latest Retry-After (if any) has passed"""
+        delay = self.__resume_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def is_transient_error(error):
+    """Checks if an error is worth retrying, such as throttling, a busy or unavailable service, or a dropped connection"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return getattr(error, 'StatusCode', None) in transient_status_codes
+
+def retry_after_seconds(error):
+    """Returns the seconds to wait before retrying, as given by the Retry-After header of the response of an error (if any)"""
+    response = getattr(error, 'Response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after is None:
+        return None
+
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+
+    # The header can also be given as an HTTP date
+    try:
+        return max((email.utils.parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def record_failed_streams(path, namespace_id, failed_streams):
+    """Appends the streams that could not be converted, along with their errors, to the failed streams file as JSON Lines"""
+    with open(path, 'a', encoding='utf-8') as f:
+        for stream, stream_view_id, error in failed_streams:
+            f.write(json.dumps({
+                'Timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'NamespaceId': namespace_id,
+                'StreamId': stream.Id,
+                'TypeId': stream.TypeId,
+                'StreamViewId': stream_view_id,
+                'StatusCode': getattr(error, 'StatusCode', None),
+                'Transient': is_transient_error(error),
+                'Error': str(error)
+            }) + '\n')
+
+class ConversionJournal:
+    """Append-only JSON Lines journal of the converted and failed streams of a namespace.
+    The streams recorded as converted are loaded as an index on open, so that an interrupted run can resume without redoing work.
+    Only that index is kept in memory: the outcomes recorded during the run are written to the file alone, so the memory used does not grow with the streams processed.
+    A journal opened with read_only only loads the index, and neither creates the file nor takes a handle to append to it"""
+
+    def __init__(self, path, namespace_id, read_only=False):
+        self.path = path
+        self.namespace_id = namespace_id
+        self.__converted = {}
+        self.__lock = threading.Lock()
+        self.__load()
+        self.__file = None if read_only else open(path, 'a', encoding='utf-8')
+
+    @classmethod
+    def read(cls, path, namespace_id):
+        """Loads the entries of an existing journal for this namespace, without opening it to append to"""
+        return cls(path, namespace_id, read_only=True)
+
+    def __load(self):
+        """Reads the streams that the existing journal entries for this namespace record as converted into the index, along with the type they were converted from and when.
+        The latest entry of a stream wins, so a stream that failed after being recorded as converted is dropped from the index"""
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A run that was killed mid-write can leave a partial last line, which is safe to ignore
+                    logging.warning(f'Ignoring unreadable journal entry in {self.path}: {line.strip()}')
+                    continue
+
+                if entry.get('NamespaceId') != self.namespace_id:
+                    continue
+                if entry['Outcome'] == 'converted':
+                    type_id = entry.get('TypeId')
+                    self.__converted[entry['StreamId']] = (sys.intern(type_id) if type_id is not None else None,
+                                                           datetime.datetime.fromisoformat(entry['Timestamp']).timestamp())
+                else:
+                    self.__converted.pop(entry['StreamId'], None)
+
+    def is_converted(self, stream_id, current_type_id=None, converted_since=None):
+        """Checks if the journal records the stream as already converted.
+        If the stream's current type id is given, the entry is only trusted while the stream is no longer on the type it was converted from,
+        so a stream that was re-created with the same id, or changed back to its existing type, is converted again.
+        If the type id was read at a known time instead, such as for the snapshot of a migration plan, pass that time (a datetime) as converted_since:
+        an entry for a stream on the type it was converted from is then trusted only if it was recorded since, as the stream was converted after its type was read"""
+        if stream_id not in self.__converted:
+            return False
+
+        type_id, converted_at = self.__converted[stream_id]
+        if current_type_id is None or current_type_id != type_id:
+            return True
+        return converted_since is not None and converted_at >= converted_since.timestamp()
+
+    def original_type_id(self, stream_id):
+        """Returns the type the stream had before the journal recorded it as converted, or None if it is not recorded as converted"""
+        return self.__converted[stream_id][0] if stream_id in self.__converted else None
+
+    def converted_count(self):
+        """Returns the number of streams the journal records as already converted"""
+        return len(self.__converted)
+
+    def record(self, stream, outcome, stream_view_id=None, error=None):
+        """Appends the outcome of a stream to the journal, flushing it so it survives the process being killed.
+        The index of converted streams is not updated, as a run never converts the same stream twice"""
+        entry = {
+            'Timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'NamespaceId': self.namespace_id,
+            'StreamId': stream.Id,
+            'TypeId': stream.TypeId,
+            'StreamViewId': stream_view_id,
+            'Outcome': outcome,
+            'Error': str(error) if error is not None else None
+        }
+
+        if self.__file is None:
+            raise ValueError(f'The journal {self.path} was opened read-only')
+
+        with self.__lock:
+            self.__file.write(json.dumps(entry) + '\n')
+            self.__file.flush()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ApiMetrics:
+    """Thread-safe call counts, error counts, and latency histograms of each ADH client operation, along with the progress of the stream conversions.
+    The metrics can be exported as a JSON summary, and as a Prometheus text file that is refreshed periodically during the run"""
+
+    # Upper bounds, in seconds, of the latency histogram buckets. Calls slower than the last bound fall in an overflow (+Inf) bucket
+    latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    def __init__(self):
+        self.calls = {}
+        self.outcomes = Counter()
+        self.total_streams = None
+        self.start_time = time.time()
+        self.merged_connections = Counter()
+        self.__connection_sources = []
+        self.__lock = threading.Lock()
+        self.__exporter = None
+        self.__stop_exporting = threading.Event()
+        self.__reporter = None
+        self.__stop_reporting = threading.Event()
+
+    def __operation(self, operation):
+        """Returns the metrics of an operation, creating them on first use. Must be called with the lock held"""
+        if operation not in self.calls:
+            self.calls[operation] = {'Count': 0, 'Errors': 0, 'SumSeconds': 0.0, 'Buckets': [0] * (len(self.latency_buckets) + 1)}
+        return self.calls[operation]
+
+    def record_call(self, operation, seconds, error=False):
+        """Records one call of an operation, such as Streams.updateStreamType"""
+        with self.__lock:
+            metrics = self.__operation(operation)
+            metrics['Count'] += 1
+            metrics['Errors'] += 1 if error else 0
+            metrics['SumSeconds'] += seconds
+            metrics['Buckets'][bisect.bisect_left(self.latency_buckets, seconds)] += 1
+
+    def record_outcome(self, outcome):
+        """Records the outcome of one stream, such as converted or skipped"""
+        with self.__lock:
+            self.outcomes[outcome] += 1
+
+    def set_total_streams(self, total_streams):
+        """Sets the number of streams to be processed, when it is known ahead of time, so that an ETA can be given"""
+        self.total_streams = total_streams
+
+    def track_connections(self, connection_stats):
+        """Includes the connection statistics of a pooled base client in the metrics, given as its connection_stats function so they are read live"""
+        self.__connection_sources.append(connection_stats)
+
+    def connection_stats(self):
+        """Returns the connection statistics of the tracked pooled base clients, added to those merged in from other processes"""
+        stats = Counter(self.merged_connections)
+        for connection_stats in self.__connection_sources:
+            stats.update(connection_stats())
+        return dict(stats)
+
+    def merge(self, state):
+        """Adds the metrics of another ApiMetrics (as returned by its state function), such as one from a namespace worker process"""
+        with self.__lock:
+            for operation, other in state['Calls'].items():
+                metrics = self.__operation(operation)
+                metrics['Count'] += other['Count']
+                metrics['Errors'] += other['Errors']
+                metrics['SumSeconds'] += other['SumSeconds']
+                metrics['Buckets'] = [mine + theirs for mine, theirs in zip(metrics['Buckets'], other['Buckets'])]
+            self.outcomes.update(state['Outcomes'])
+            self.merged_connections.update(state.get('Connections', {}))
+
+    def state(self):
+        """Returns a copy of the raw metrics, which can be sent between processes and merged"""
+        with self.__lock:
+            calls = {operation: dict(metrics, Buckets=list(metrics['Buckets'])) for operation, metrics in self.calls.items()}
+            outcomes = dict(self.outcomes)
+        return {'Calls': calls, 'Outcomes': outcomes, 'Connections': self.connection_stats()}
+
+    def percentile(self, operation, percent):
+        """Estimates a latency percentile of an operation as the upper bound of the histogram bucket it falls in (None for the overflow bucket)"""
+        metrics = self.calls[operation]
+        rank = percent / 100 * metrics['Count']
+        cumulative = 0
+        for upper_bound, count in zip(self.latency_buckets + [None], metrics['Buckets']):
+            cumulative += count
+            if cumulative >= rank:
+                return upper_bound
+        return None
+
+    def progress(self):
+        """Returns the number of streams processed so far, the throughput in streams per second, and the estimated seconds remaining (None if the total is unknown)"""
+        with self.__lock:
+            processed = sum(self.outcomes.values())
+        elapsed = time.time() - self.start_time
+        throughput = processed / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if self.total_streams is not None and throughput > 0:
+            eta = max(self.total_streams - processed, 0) / throughput
+
+        return processed, throughput, eta
+
+    def progress_line(self):
+        """Returns a one line summary of the progress of the stream conversions, to be shown on the console"""
+        processed, throughput, eta = self.progress()
+        with self.__lock:
+            outcomes = Counter(self.outcomes)
+
+        line = f'Processed {processed}' + (f' of {self.total_streams}' if self.total_streams is not None else '') + ' streams'
+        line += f' ({outcomes["converted"]} converted, {outcomes["skipped"]} skipped, {outcomes["failed"]} failed'
+        line += f', {outcomes["previously_converted"]} previously converted)' if outcomes['previously_converted'] else ')'
+        line += f' at {throughput:.1f} streams/s'
+        if eta is not None:
+            line += f', about {eta:.0f} seconds remaining'
+        return line
+
+    def summary(self):
+        """Returns a JSON serializable summary of every metric"""
+        processed, throughput, eta = self.progress()
+        connections = self.connection_stats()
+        with self.__lock:
+            return {
+                'ElapsedSeconds': round(time.time() - self.start_time, 3),
+                'Connections': connections,
+                'Streams': {
+                    'Total': self.total_streams,
+                    'Processed': processed,
+                    'Outcomes': dict(self.outcomes),
+                    'StreamsPerSecond': round(throughput, 2),
+                    'EtaSeconds': round(eta, 1) if eta is not None else None
+                },
+                'Calls': {
+                    operation: {
+                        'Count': metrics['Count'],
+                        'Errors': metrics['Errors'],
+                        'MeanSeconds': round(metrics['SumSeconds'] / metrics['Count'], 4) if metrics['Count'] else None,
+                        'P50Seconds': self.percentile(operation, 50),
+                        'P99Seconds': self.percentile(operation, 99),
+                        'Histogram': {str(upper_bound): count for upper_bound, count in zip(self.latency_buckets + ['+Inf'], metrics['Buckets'])}
+                    }
+                    for operation, metrics in self.calls.items()
+                }
+            }
+
+    def prometheus_text(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        processed, throughput, eta = self.progress()
+        connections = self.connection_stats()
+        lines = []
+
+        with self.__lock:
+            lines += ['# HELP adh_client_calls_total Number of ADH client calls by operation.', '# TYPE adh_client_calls_total counter']
+            lines += [f'adh_client_calls_total{{operation="{operation}"}} {metrics["Count"]}' for operation, metrics in self.calls.items()]
+
+            lines += ['# HELP adh_client_errors_total Number of ADH client calls that raised an error, by operation.', '# TYPE adh_client_errors_total counter']
+            lines += [f'adh_client_errors_total{{operation="{operation}"}} {metrics["Errors"]}' for operation, metrics in self.calls.items()]
+
+            lines += ['# HELP adh_client_call_duration_seconds Latency of ADH client calls by operation.', '# TYPE adh_client_call_duration_seconds histogram']
+            for operation, metrics in self.calls.items():
+                cumulative = 0
+                for upper_bound, count in zip(self.latency_buckets + ['+Inf'], metrics['Buckets']):
+                    cumulative += count
+                    lines.append(f'adh_client_call_duration_seconds_bucket{{operation="{operation}",le="{upper_bound}"}} {cumulative}')
+                lines.append(f'adh_client_call_duration_seconds_sum{{operation="{operation}"}} {metrics["SumSeconds"]}')
+                lines.append(f'adh_client_call_duration_seconds_count{{operation="{operation}"}} {metrics["Count"]}')
+
+            lines += ['# HELP stream_conversion_streams_total Number of streams processed, by outcome.', '# TYPE stream_conversion_streams_total counter']
+            lines += [f'stream_conversion_streams_total{{outcome="{outcome}"}} {count}' for outcome, count in self.outcomes.items()]
+
+        if connections:
+            lines += ['# HELP adh_client_http_requests_total Number of HTTP requests sent through the connection pool.', '# TYPE adh_client_http_requests_total counter']
+            lines.append(f'adh_client_http_requests_total {connections.get("Requests", 0)}')
+            lines += ['# HELP adh_client_connections_opened_total Number of connections opened by the connection pool.', '# TYPE adh_client_connections_opened_total counter']
+            lines.append(f'adh_client_connections_opened_total {connections.get("ConnectionsOpened", 0)}')
+            lines += ['# HELP adh_client_token_refreshes_total Number of times the bearer token was refreshed.', '# TYPE adh_client_token_refreshes_total counter']
+            lines.append(f'adh_client_token_refreshes_total {connections.get("TokenRefreshes", 0)}')
+
+        lines += ['# HELP stream_conversion_streams_per_second Average number of streams processed per second.', '# TYPE stream_conversion_streams_per_second gauge']
+        lines.append(f'stream_conversion_streams_per_second {throughput}')
+
+        if self.total_streams is not None:
+            lines += ['# HELP stream_conversion_streams_expected Number of streams to be processed.', '# TYPE stream_conversion_streams_expected gauge']
+            lines.append(f'stream_conversion_streams_expected {self.total_streams}')
+        if eta is not None:
+            lines += ['# HELP stream_conversion_eta_seconds Estimated seconds until every stream is processed.', '# TYPE stream_conversion_eta_seconds gauge']
+            lines.append(f'stream_conversion_eta_seconds {eta}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        """Writes the JSON summary of every metric to a file"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        """Writes every metric to a Prometheus text file, replacing it in one step so a scraper never reads a partial file"""
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(f'{path}.tmp', path)
+
+    def start_exporting(self, path, interval):
+        """Starts refreshing the Prometheus text file every interval seconds on a background thread"""
+        def export():
+            while not self.__stop_exporting.wait(interval):
+                try:
+                    self.write_prometheus(path)
+                except Exception as error:
+                    logging.warning(f'Could not write the metrics to {path}: {error}')
+
+        self.__exporter = threading.Thread(target=export, daemon=True)
+        self.__exporter.start()
+
+    def start_reporting_progress(self, interval):
+        """Starts showing the progress of the stream conversions on the console every interval seconds on a background thread,
+        in place of a line per stream. Nothing is shown while no stream is being processed, such as during the enumeration"""
+        def report():
+            last_processed = 0
+            while not self.__stop_reporting.wait(interval):
+                processed = self.progress()[0]
+                if processed != last_processed:
+                    print(self.progress_line())
+                    last_processed = processed
+
+        self.__reporter = threading.Thread(target=report, daemon=True)
+        self.__reporter.start()
+
+    def stop_reporting_progress(self):
+        """Stops showing the progress of the stream conversions on the console"""
+        if self.__reporter is not None:
+            self.__stop_reporting.set()
+            self.__reporter.join()
+            self.__reporter = None
+
+    def stop_exporting(self):
+        """Stops refreshing the Prometheus text file"""
+        if self.__exporter is not None:
+            self.__stop_exporting.set()
+            self.__exporter.join()
+            self.__exporter = None
+
+def library_attribute(library_object, name):
+    """Returns a private attribute of an object of the sample library, which the pooled client relies on. As it is not part of the library's interface,
+    an error is raised if it is missing, such as after an upgrade of the library, rather than quietly going without it"""
+    if not hasattr(library_object, name):
+        raise Exception(f'{type(library_object).__name__} of the installed adh_sample_library_preview has no attribute {name}, which this sample relies on. '
+                        f'Install the version of the library pinned in requirements.txt.')
+    return getattr(library_object, name)
+
+class PooledBaseClient(BaseClient):
+    """ADH base client whose HTTP session keeps a pool of persistent keep-alive connections sized to the number of concurrent workers,
+    and whose bearer token is refreshed on a background thread before it expires, so that neither a TLS handshake nor a token request
+    lands on the path of a stream conversion. The reuse of the pooled connections is tracked by connection_stats"""
+
+    def __init__(self, api_version, tenant, url, client_id=None, client_secret=None, pool_size=default_max_concurrency, token_refresh_interval=default_token_refresh_interval):
+        super().__init__(api_version, tenant, url, client_id, client_secret)
+        self.__adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session = library_attribute(self, '_BaseClient__session')
+        self.__auth_object = library_attribute(self, '_BaseClient__auth_object')
+        if self.__auth_object is not None:
+            library_attribute(self.__auth_object, '_Authentication__expiration')
+        self.__session.mount('https://', self.__adapter)
+        self.__session.mount('http://', self.__adapter)
+
+        self.__token_lock = threading.Lock()
+        self.__token = None
+        self.__token_refreshes = 0
+        self.__stop_refreshing = threading.Event()
+        self.__refresher = None
+
+        if client_id is not None:
+            # The base client has just requested the first token, so this reads it back without another request
+            self.__token = super()._getToken()
+            self.__refresher = threading.Thread(target=self.__keep_token_fresh, args=(token_refresh_interval,), daemon=True)
+            self.__refresher.start()
+
+    def __refresh_token(self):
+        """Asks the authentication object for the token, which only requests a new one when the current one is within 5 minutes of expiring"""
+        token = super()._getToken()
+        with self.__token_lock:
+            if token != self.__token:
+                self.__token = token
+                self.__token_refreshes += 1
+
+    def __keep_token_fresh(self, interval):
+        """Checks the token every interval seconds, which must be well under 5 minutes for it to be refreshed ahead of time"""
+        while not self.__stop_refreshing.wait(interval):
+            try:
+                self.__refresh_token()
+            except Exception as error:
+                # The token is still valid for a few minutes, so the refresh is attempted again on the next interval. Should it expire first, _getToken refreshes it
+                logging.warning(f'Could not refresh the bearer token, will try again in {interval} seconds: {error}')
+
+    def __token_expired(self):
+        """Checks if the cached token has expired, or is about to. The expiry is tracked by the authentication object of the base client"""
+        return self.__auth_object._Authentication__expiration - time.time() <= token_expiry_margin
+
+    def _getToken(self):
+        """Returns the bearer token kept fresh by the background thread, without requesting one on the caller's thread while it is valid.
+        If the background refreshes kept failing until the token expired, it is refreshed here instead, so no request is sent with an expired token"""
+        with self.__token_lock:
+            if self.__token is not None and self.__token_expired():
+                token = super()._getToken()
+                if token != self.__token:
+                    self.__token = token
+                    self.__token_refreshes += 1
+            return self.__token
+
+    def connection_stats(self):
+        """Returns the number of requests sent, the number of connections opened to send them, and the number of token refreshes"""
+        requests_sent = 0
+        connections_opened = 0
+        pools = self.__adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+
+        return {'Requests': requests_sent, 'ConnectionsOpened': connections_opened, 'ReusedConnections': max(requests_sent - connections_opened, 0),
+                'TokenRefreshes': self.__token_refreshes}
+
+    def close(self):
+        """Stops refreshing the token and closes the pooled connections"""
+        if self.__refresher is not None:
+            self.__stop_refreshing.set()
+            self.__refresher.join()
+            self.__refresher = None
+        self.__session.close()
+
+class InstrumentedADHClient:
+    """Wraps an ADH client so that every call made through its Types, Streams, StreamViews, and Namespaces clients is recorded in the given metrics"""
+
+    instrumented_services = {'Types', 'Streams', 'StreamViews', 'Namespaces'}
+
+    def __init__(self, adh_client, metrics):
+        self.adh_client = adh_client
+        self.metrics = metrics
+        self.__services = {}
+
+    def __getattr__(self, name):
+        if name not in self.instrumented_services:
+            return getattr(self.adh_client, name)
+        if name not in self.__services:
+            self.__services[name] = InstrumentedService(getattr(self.adh_client, name), name, self.metrics)
+        return self.__services[name]
+
+class InstrumentedService:
+    """Wraps one of the clients of an ADH client (such as Streams), timing each of its functions"""
+
+    def __init__(self, service, service_name, metrics):
+        self.service = service
+        self.service_name = service_name
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        function = getattr(self.service, name)
+        if not callable(function):
+            return function
+
+        operation = f'{self.service_name}.{name}'
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                self.metrics.record_call(operation, time.perf_counter() - start, error=True)
+                raise
+            self.metrics.record_call(operation, time.perf_counter() - start)
+            return result
+
+        # Keep the wrapper, so the lookup only happens once per function
+        setattr(self, name, timed)
+        return timed
+
+def call_with_retries(function, description, retry_policy=default_retry_policy, concurrency=None):
+    """Calls the function, retrying it after a transient error with a jittered exponential backoff (or after the Retry-After given by ADH).
+    If an adaptive concurrency limit is given, the latency of each successful call and each transient error are reported to it.
+    Returns the result of the function, or raises the last error once it is permanent or the retries run out"""
+    attempt = 0
+    while True:
+        if concurrency is not None:
+            concurrency.wait_until_resumed()
+
+        start = time.monotonic()
+        try:
+            result = function()
+            if concurrency is not None:
+                concurrency.record_success(start, time.monotonic() - start)
+            return result
+
+        except Exception as error:
+            if not is_transient_error(error) or attempt >= retry_policy.MaxRetries:
+                raise
+
+            retry_after = retry_after_seconds(error)
+            if concurrency is not None:
+                concurrency.record_throttled(start, retry_after)
+
+            # Full jitter, so that the workers throttled at the same moment do not all retry at the same moment
+            delay = retry_after if retry_after else random.uniform(0, min(retry_policy.MaxDelaySeconds, retry_policy.BaseDelaySeconds * 2 ** attempt))
+            attempt += 1
+            logging.warning(f'Retrying {description} in {delay:.2f} seconds (attempt {attempt} of {retry_policy.MaxRetries}) after a transient error: {error}')
+            time.sleep(delay)
+
+def has_target_type(adh_client, namespace_id, stream_id, stream_view_id, retry_policy=default_retry_policy):
+    """Checks whether a stream already has the target type of the given stream view. An error while checking is logged, and counts as not having it"""
+    try:
+        target_type_id = call_with_retries(lambda: adh_client.StreamViews.getStreamView(namespace_id, stream_view_id).TargetTypeId,
+                                           f'the lookup of stream view {stream_view_id}', retry_policy)
+        type_id = call_with_retries(lambda: adh_client.Streams.getStreamType(namespace_id, stream_id).Id, f'the lookup of the type of {stream_id}', retry_policy)
+        return type_id == target_type_id
+    except Exception as error:
+        log_stream(logging.WARNING, f'Could not check whether {stream_id} already has the target type of {stream_view_id}: {error}')
+        return False
+
+def convert_stream(adh_client, namespace_id, stream, stream_view_id, concurrency=None, retry_policy=default_retry_policy):
+    """Changes the type of a single stream using the given stream view, and returns the outcome along with any error encountered.
+    Transient errors are retried according to the retry policy, and reported to the adaptive concurrency limit if any.
+    A call that failed with a transient error (such as a timeout or a 502) may still have been carried out by ADH, in which case the retry fails with a permanent error,
+    as the stream is no longer on the source type of the stream view. So when a retry fails that way, the stream is counted as converted if it already has the target type"""
+    log_stream(logging.INFO, f'Changing type of {stream.Id} away from {stream.TypeId} using steamview id {stream_view_id}...')
+    attempts = 0
+
+    def update_stream_type():
+        nonlocal attempts
+        attempts += 1
+        adh_client.Streams.updateStreamType(namespace_id, stream_id=stream.Id, stream_view_id=stream_view_id)
+
+    try:
+        call_with_retries(update_stream_type, f'the type change of {stream.Id}', retry_policy, concurrency)
+        return 'converted', None
+    except Exception as error:
+        if attempts > 1 and not is_transient_error(error) and has_target_type(adh_client, namespace_id, stream.Id, stream_view_id, retry_policy):
+            log_stream(logging.INFO, f'{stream.Id} already has the target type of {stream_view_id}, so an earlier attempt was carried out despite its error')
+            return 'converted', None
+
+        log_stream(logging.ERROR, f'Encountered error while converting stream {stream.Id}: {error}')
+        return 'failed', error
+
+def convert_streams(adh_client, namespace_id, streams, type_to_stream_view_mappings, max_concurrency=default_max_concurrency, journal=None, metrics=None,
+                    concurrency=None, retry_policy=default_retry_policy, failed_streams=None, converted_since=None):
+    """Converts the given streams across a bounded pool of worker threads.
+    If a journal is given, streams it records as converted are not converted again, and the outcome of every conversion is appended to it.
+    Skipped streams are not journaled, as they are skipped again on every run anyway.
+    A stream's journal entry is only trusted if the stream is no longer on the type it was converted from, or, when the type ids of the streams were read at
+    converted_since rather than just now (such as for the snapshot of a migration plan), if the entry was recorded since.
+    If metrics are given, the outcome of every stream is counted in them to track the progress.
+    If an adaptive concurrency limit is given, the number of conversions in flight follows it (up to max_concurrency), otherwise it is fixed at max_concurrency.
+    Transient errors are retried according to the retry policy, and the streams that still fail are appended to failed_streams (if given) along with their errors.
+    Returns a tally of the converted, skipped, failed, and previously converted streams, along with the last error encountered (if any)"""
+
+    tally = Counter(converted=0, skipped=0, failed=0, previously_converted=0)
+    exception = None
+
+    def collect(futures):
+        """Adds the outcomes of the finished conversions to the tally and the journal"""
+        nonlocal exception
+        for future in futures:
+            stream, stream_view_id = in_flight.pop(future)
+            if future.cancelled():
+                continue
+
+            outcome, error = future.result()
+            tally[outcome] += 1
+            if error is not None:
+                exception = error
+                if failed_streams is not None:
+                    failed_streams.append((stream, stream_view_id, error))
+            if journal is not None:
+                journal.record(stream, outcome, stream_view_id, error)
+            if metrics is not None:
+                metrics.record_outcome(outcome)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight = {}
+        type_id = stream_view_id = None
+
+        try:
+            for stream in streams:
+
+                # Look for the stream's existing type in the mappings table. The streams of a StreamCatalog arrive one type after another,
+                # so the table is only consulted when the type changes
+                if stream.TypeId != type_id:
+                    type_id = stream.TypeId
+                    stream_view_id = type_to_stream_view_mappings.get(type_id)
+
+                # Streams converted by an earlier, interrupted run are passed over without another call to ADH
+                if journal is not None and journal.is_converted(stream.Id, stream.TypeId, converted_since):
+                    tally['previously_converted'] += 1
+                    if metrics is not None:
+                        metrics.record_outcome('previously_converted')
+
+                # If the stream's existing type is in the mappings table, queue up the conversion using the stream view
+                elif stream_view_id is not None:
+
+                    # Only keep a bounded number of conversions queued, so the streams are not all submitted to the pool up front.
+                    # With an adaptive limit, only as many conversions as it currently allows are in flight
+                    while len(in_flight) >= (concurrency.limit if concurrency is not None else 2 * max_concurrency):
+                        collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+
+                    future = executor.submit(convert_stream, adh_client, namespace_id, stream, stream_view_id, concurrency, retry_policy)
+                    in_flight[future] = (stream, stream_view_id)
+
+                # If it's not, skip it and notify the user why it wasn't processed
+                else:
+                    log_stream(logging.WARNING, f'Skipped {stream.Id} because it has a type of {stream.TypeId}, which is not in the mappings table. It will need to be migrated separately.')
+                    tally['skipped'] += 1
+                    if metrics is not None:
+                        metrics.record_outcome('skipped')
+
+        except BaseException:
+            # On an interruption (such as Ctrl-C), drop the queued conversions but still record the ones already sent
+            for future in in_flight:
+                future.cancel()
+            raise
+
+        finally:
+            collect(wait(in_flight).done)
+
+    return tally, exception
+
+def get_all(get_page, namespace_id, query, page_size=default_page_size):
+    """Pages through every result of a collection search (such as Types.getTypes or StreamViews.getStreamViews) using skip and count,
+    and returns them as one list"""
+    results = []
+    while True:
+        page = call_with_retries(lambda: get_page(namespace_id, skip=len(results), count=page_size, query=query), f'the page of results at {len(results)}')
+        results.extend(page)
+
+        # A short page means the end of the search results has been reached
+        if len(page) < page_size:
+            return results
+
+def load_stream_view_cache(cache_file, cache_key):
+    """Returns the cached mapping of existing type id to stream view for the given key, or None if there is none"""
+    if not cache_file or not os.path.exists(cache_file):
+        return None
+
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f).get(cache_key)
+    except Exception as error:
+        output(logging.WARNING, f'Could not read the stream view cache {cache_file}, it will be rebuilt: {error}')
+        return None
+
+def save_stream_view_cache(cache_file, cache_key, cached_mapping):
+    """Stores the mapping of existing type id to stream view under the given key, keeping the entries of other keys"""
+    if not cache_file:
+        return
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except Exception:
+            cache = {}
+
+    cache[cache_key] = cached_mapping
+
+    # Write to a temporary file first, so an interruption never leaves a half-written cache behind
+    with open(f'{cache_file}.tmp', 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(f'{cache_file}.tmp', cache_file)
+
+def stream_view_is_current(cached_stream_view, existing_type_id, existing_stream_views):
+    """Checks if a cached stream view still exists on the namespace and still maps the existing type to the same target type"""
+    stream_view = existing_stream_views.get(cached_stream_view['StreamViewId'])
+    return stream_view is not None and stream_view.SourceTypeId == existing_type_id and stream_view.TargetTypeId == cached_stream_view['TargetTypeId']
+
+def check_adapter_type(adapter_type):
+    """Checks the adapter type against the known tested and incompatible adapter types, raising an exception for an incompatible one"""
 
     # Some adapters have known types that will not be migratable, for example DNP3. These should be skipped
     tested_adapter_types = {'opcua'}
@@ -48,190 +1141,1145 @@ def generate_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, te
     if adapter_type.lower() not in tested_adapter_types:
         output(logging.WARNING, f'Encountered untested adapter type of {adapter_type}. The konwn tested adapter types are {", ".join(tested_adapter_types)}. If this was unintended, please rerun the script with the correct adapter type.')
 
-
-    mapping = {}
-    
-    # Find types created by the adapter upgrade (TimeIndexed.<datatype>.<AdapterType>Quality):
+def find_adapter_upgrade_types(adapter_type, adh_client, namespace_id):
+    """Returns the types created by the adapter upgrade (TimeIndexed.<datatype>.<AdapterType>Quality), raising an exception if there are none"""
     type_search_query = f'TimeIndexed.* AND *.{adapter_type}Quality'
-    new_types = adh_client.Types.getTypes(namespace_id, query=type_search_query)
+    new_types = get_all(adh_client.Types.getTypes, namespace_id, type_search_query)
 
     if len(new_types) == 0:
         output(logging.ERROR, 'No PI Adapter v1.2 types were detected on the namespace for this adapter type. Be sure to upgrade the adapter before running this script. Quitting...')
         raise Exception(f'No PI Adapter v1.2 types were detected on this namespace.')
 
+    return new_types
 
-    if test:
-        # If this script is being E2E tested, presume the user input to be y
-        response = 'y'
-        output(logging.DEBUG, f'Automated test will begin stream view creation without prompting the user, assuming a response of {response}.')
-        
+def adapter_upgrade_stream_views(adapter_type, new_types):
+    """Returns the stream views (without creating them) that map each existing version 1.1 type to its corresponding new version 1.2 type"""
+    stream_views = []
+    for new_type in new_types:
 
-    else: 
-        # Before creating the stream views, user confirmation is requested
-        output(logging.INFO, f'Found {len(new_types)} types that are potentially going to be have stream views created to map existing types to them.')
-        logging.debug(f'Prompting user whether they would like to see the list of new type IDs.')
-        response = input('Would you like to see their IDs? (y/n): ')
-        logging.debug(f'Response: {response}')
-        print()
+        # Extract out the data type from the type name, and infer the existing type name
+        type_name_parts = new_type.Id.split('.')
 
-        if affirmative_response(response):
-            for new_type in new_types:
-                output(logging.INFO, new_type.Id)
+        # The 'simple' types (eg. TimeIndexed.Int32.OpcUaQuality) are three pieces: 0 = 'TimeIndexed'; 1 = <data type>; 2 = '<adapter_type>Quality
+        # Others, such as 'enum' types are more pieces and cannot be migrated with this script
+        if len(type_name_parts) > 3:
+            output(logging.WARNING, f'Non-simple type detected. No streams will be automatically migrated to {new_type}...')
+            output(logging.WARNING, f'...If possible, the existing steams will be converted to their corresponding integer quality type.')
+            continue
 
-        print()
-        logging.debug(f'Prompting user whether they would like to continue with the stream view creations.')
-        response = input('Would you like to create the stream views? (y/n): ')
-        logging.debug(f'Response: {response}')
-        print()
-    
-    if affirmative_response(response):
-
-        for new_type in new_types:
-
-            # Extract out the data type from the type name, and infer the existing type name
-            type_name_parts = new_type.Id.split('.')
-            
-            # The 'simple' types (eg. TimeIndexed.Int32.OpcUaQuality) are three pieces: 0 = 'TimeIndexed'; 1 = <data type>; 2 = '<adapter_type>Quality
-            # Others, such as 'enum' types are more pieces and cannot be migrated with this script
-            if len(type_name_parts) > 3:
-                output(logging.WARNING, f'Non-simple type detected. No streams will be automatically migrated to {new_type}...')
-                output(logging.WARNING, f'...If possible, the existing steams will be converted to their corresponding integer quality type.')
+        # The version 1.1 SDS Type ID is the first two parts joined back together (eg. TimeIndexed.Int32.OpcUaQuality -> TimeIndexed.Int32)
+        existing_type_id = '.'.join(type_name_parts[:2])
+
+        # The data type is the second piece of 0 = 'TimeIndexed'; 1 = <data type>; 2 = '<adapter_type>Quality
+        data_type = type_name_parts[1]
+
+        # Create the stream views from existing type to new type
+        # Note: Explicit property mappings are not required for this conversion because ADH can infer them from the property names
+        this_stream_view_id = f'{adapter_type}_{data_type}_quality'
+        stream_views.append(SdsStreamView(id=this_stream_view_id, source_type_id=existing_type_id, target_type_id=new_type.Id))
+
+    return stream_views
+
+def glob_to_regex(pattern):
+    """Translates a glob pattern into a regular expression in which each wildcard is a numbered group, so the text it matched can be used in the templates"""
+    return ''.join('(.*)' if character == '*' else '(.)' if character == '?' else re.escape(character) for character in pattern)
+
+class MappingRules:
+    """The rules of a mapping rules file, which map each existing type id to the id of its new type and of the stream view that converts it.
+    A rule selects existing type ids by an exact TypeId, a Glob, or a Regex, and gives the TargetTypeId and StreamViewId as templates,
+    which can use {adapter_type}, {type_id}, the named groups of a regex, and {0}, {1}, ... for the unnamed groups or the wildcards of a glob.
+    A TargetTypeId of null leaves the matching types unconverted. Rules with an AdapterType only apply to that adapter type.
+    The rules are compiled once into an index of the exact type ids, which take precedence, and a list of patterns that are tried in order.
+    The outcome for each distinct type id is memoized, so resolving a type id again is a single dictionary lookup"""
+
+    def __init__(self, rules, adapter_type, source='the mapping rules'):
+        self.adapter_type = adapter_type
+        self.source = source
+
+        # The rules are identified by a digest of their content, so cached stream views are not reused after the rules change
+        self.digest = hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+        self.__exact = {}
+        self.__patterns = []
+        self.__resolved = {}
+
+        for number, rule in enumerate(rules, start=1):
+            selectors = [selector for selector in mapping_rule_selectors if selector in rule]
+            if len(selectors) != 1:
+                raise Exception(f'Mapping rule {number} of {source} must have exactly one of {", ".join(mapping_rule_selectors)}.')
+            if 'TargetTypeId' not in rule or (rule['TargetTypeId'] is not None and 'StreamViewId' not in rule):
+                raise Exception(f'Mapping rule {number} of {source} must have a TargetTypeId, and a StreamViewId unless the TargetTypeId is null.')
+
+            # Rules for other adapter types are left out of the compiled rules altogether
+            if rule.get('AdapterType') is not None and rule['AdapterType'].lower() != adapter_type.lower():
                 continue
 
-            # The version 1.1 SDS Type ID is the first two parts joined back together (eg. TimeIndexed.Int32.OpcUaQuality -> TimeIndexed.Int32)
-            existing_type_id = '.'.join(type_name_parts[:2])
+            templates = (rule['TargetTypeId'], rule.get('StreamViewId'))
+            selector = selectors[0]
+            if selector == 'TypeId':
+                # The first rule for an exact type id wins, as it would for the patterns
+                self.__exact.setdefault(rule['TypeId'], templates)
+            else:
+                try:
+                    pattern = re.compile(rule['Regex'] if selector == 'Regex' else glob_to_regex(rule['Glob']))
+                except re.error as error:
+                    raise Exception(f'Mapping rule {number} of {source} has an invalid {selector}: {error}')
+                self.__patterns.append((pattern, templates))
 
-            # The data type is the second piece of 0 = 'TimeIndexed'; 1 = <data type>; 2 = '<adapter_type>Quality
-            data_type = type_name_parts[1]
+    def __len__(self):
+        return len(self.__exact) + len(self.__patterns)
 
-            # Create the stream views from existing type to new type
-            # Note: Explicit property mappings are not required for this conversion because ADH can infer them from the property names
-            this_stream_view_id = f'{adapter_type}_{data_type}_quality'
-            this_stream_view = SdsStreamView(id=this_stream_view_id, source_type_id=existing_type_id, target_type_id=new_type.Id)
+    def resolve(self, type_id):
+        """Returns the new type id and stream view id for an existing type id, or None if no rule maps it"""
+        try:
+            return self.__resolved[type_id]
+        except KeyError:
+            pass
 
-            output(logging.INFO, f'Creating stream view with id {this_stream_view_id} mapping {existing_type_id} to {new_type.Id}...')
-            try:
-                this_stream_view = adh_client.StreamViews.getOrCreateStreamView(namespace_id, this_stream_view)
-            except Exception as error:
-                # Log the error, but don't raise the exception. This failure is only a problem if it causes a stream to fail to convert, which will be caught later as a separate exception
-                output(logging.ERROR, f'Encountered error while creating stream view with id {this_stream_view_id}: {error}')
-                output(logging.ERROR, f'This script will continue but may fail later when attempting to convert streams from {existing_type_id} to {new_type.Id}.')
-                
-                
-            # Add the streamview id to the mappings list under the key of the existing type id
-            mapping[existing_type_id] = this_stream_view.Id
+        resolved = None
+        if type_id in self.__exact:
+            resolved = self.__render(type_id, self.__exact[type_id], (), {})
+        else:
+            for pattern, templates in self.__patterns:
+                match = pattern.fullmatch(type_id)
+                if match is not None:
+                    resolved = self.__render(type_id, templates, match.groups(), match.groupdict())
+                    break
+
+        self.__resolved[type_id] = resolved
+        return resolved
+
+    def __render(self, type_id, templates, groups, named_groups):
+        """Fills in the templates of a rule for an existing type id"""
+        target_type_template, stream_view_template = templates
+        if target_type_template is None:
+            return None
+
+        try:
+            return tuple(template.format(*groups, type_id=type_id, adapter_type=self.adapter_type, **named_groups)
+                         for template in (target_type_template, stream_view_template))
+        except (IndexError, KeyError) as error:
+            raise Exception(f'The templates {target_type_template} and {stream_view_template} of {self.source} cannot be filled in for the type {type_id}: unknown field {error}')
+
+@functools.lru_cache(maxsize=None)
+def load_mapping_rules(mapping_rules_file, adapter_type):
+    """Reads and compiles the rules of a mapping rules file for an adapter type. Each file is only read and compiled once per process"""
+    with open(mapping_rules_file, 'r') as f:
+        rules = json.load(f)
+
+    mapping_rules = MappingRules(rules.get('Rules', []), adapter_type, mapping_rules_file)
+    if len(mapping_rules) == 0:
+        raise Exception(f'No mapping rules in {mapping_rules_file} apply to the adapter type of {adapter_type}.')
+
+    logging.debug(f'Compiled {len(mapping_rules)} mapping rules from {mapping_rules_file} for {adapter_type}')
+    return mapping_rules
+
+def rule_stream_views(mapping_rules, adh_client, namespace_id):
+    """Returns the stream views (without creating them) that the mapping rules give for the types of the namespace, which are listed with one bulk query.
+    Types whose new type is not on the namespace, and the new types themselves, are left out"""
+    type_ids = [sds_type.Id for sds_type in get_all(adh_client.Types.getTypes, namespace_id, '')]
+    resolved_types = {type_id: mapping_rules.resolve(type_id) for type_id in type_ids}
+    existing_type_ids = set(type_ids)
+    target_type_ids = {resolved[0] for resolved in resolved_types.values() if resolved is not None}
+
+    stream_views = []
+    stream_view_sources = {}
+    for type_id, resolved in resolved_types.items():
+        if resolved is None or type_id in target_type_ids:
+            continue
+
+        target_type_id, stream_view_id = resolved
+        if target_type_id not in existing_type_ids:
+            output(logging.WARNING, f'The mapping rules map {type_id} to {target_type_id}, which does not exist on namespace {namespace_id}. No streams of {type_id} will be migrated.')
+            continue
+
+        if stream_view_id in stream_view_sources:
+            output(logging.WARNING, f'The mapping rules give the stream view id {stream_view_id} to both {stream_view_sources[stream_view_id]} and {type_id}. No streams of {type_id} will be migrated.')
+            continue
+
+        stream_view_sources[stream_view_id] = type_id
+        stream_views.append(SdsStreamView(id=stream_view_id, source_type_id=type_id, target_type_id=target_type_id))
+
+    if len(stream_views) == 0:
+        output(logging.ERROR, f'The mapping rules in {mapping_rules.source} do not map any type on the namespace to a new type on it. Quitting...')
+        raise Exception(f'No types on namespace {namespace_id} are mapped by the mapping rules.')
+
+    return stream_views
+
+def find_stream_views(adapter_type, adh_client, namespace_id, mapping_rules=None):
+    """Returns the stream views (without creating them) that map each existing type to its new type,
+    following the mapping rules if given, or the adapter version 1.1 to 1.2 naming convention otherwise"""
+    if mapping_rules is not None:
+        return rule_stream_views(mapping_rules, adh_client, namespace_id)
+
+    check_adapter_type(adapter_type)
+    return adapter_upgrade_stream_views(adapter_type, find_adapter_upgrade_types(adapter_type, adh_client, namespace_id))
+
+def stream_view_search_query(adapter_type, mapping_rules=None):
+    """Returns the query that lists the stream views this script creates on a namespace.
+    The stream view ids given by mapping rules follow no set convention, so all stream views are listed for them"""
+    if mapping_rules is not None:
+        return ''
+
+    # The stream views of the naming convention are all named <adapter_type>_<data_type>_quality, so they can all be listed with one query
+    return f'{adapter_type}_* AND *_quality'
+
+def stream_view_cache_key(adapter_type, namespace_id, mapping_rules=None):
+    """Returns the key of the stream views of a namespace and adapter type in the stream view cache, which also depends on the mapping rules (if any)"""
+    if mapping_rules is None:
+        return f'{namespace_id}/{adapter_type}'
+    return f'{namespace_id}/{adapter_type}/{mapping_rules.digest}'
+
+def cached_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, cache_file, mapping_rules=None):
+    """Returns the mapping table cached in the cache file for a namespace and adapter type, once a single bulk stream view query has confirmed that every cached
+    stream view is still in place, along with the set of the target type ids of the cached stream views. Returns None if nothing is cached, or the cache no longer
+    matches the stream views on the namespace. The types on the namespace are not queried, so a cached mapping does not cover the types added since it was written"""
+    cached_mapping = load_stream_view_cache(cache_file, stream_view_cache_key(adapter_type, namespace_id, mapping_rules))
+    if not cached_mapping:
+        return None
+
+    search_query = stream_view_search_query(adapter_type, mapping_rules)
+    existing_stream_views = {stream_view.Id: stream_view for stream_view in get_all(adh_client.StreamViews.getStreamViews, namespace_id, search_query)}
+
+    if not all(stream_view_is_current(cached_stream_view, existing_type_id, existing_stream_views) for existing_type_id, cached_stream_view in cached_mapping.items()):
+        output(logging.WARNING, f'The stream views cached in {cache_file} for {adapter_type} on namespace {namespace_id} no longer match the namespace. They will be regenerated.')
+        return None
+
+    output(logging.INFO, f'Using the {len(cached_mapping)} stream views cached in {cache_file} for {adapter_type} on namespace {namespace_id}. Delete this file to regenerate them.')
+    mapping = {existing_type_id: cached_stream_view['StreamViewId'] for existing_type_id, cached_stream_view in cached_mapping.items()}
+    return mapping, {cached_stream_view['TargetTypeId'] for cached_stream_view in cached_mapping.values()}
+
+def uncovered_type_ids(type_ids, type_to_stream_view_mappings, target_type_ids):
+    """Returns the type ids that are neither mapped nor the target of a mapping, such as types added by the adapter since a cached mapping table was written"""
+    return [type_id for type_id in type_ids if type_id not in type_to_stream_view_mappings and type_id not in target_type_ids]
+
+def generate_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, test, max_concurrency=default_max_concurrency, cache_file=None, mapping_rules=None, use_cache=True):
+    """This function takes in an adapter type (such as 'OpcUa'), generates the necessary stream views,
+    and returns a mapping table for the existing type to the stream view that maps it to the new type.
+    The stream views follow the mapping rules if given, or the adapter version 1.1 to 1.2 naming convention otherwise.
+    The stream views are created concurrently, and the resulting mapping is cached in the cache file (if given), keyed by namespace and adapter type (and the mapping rules).
+    On later runs (unless use_cache is False) the cache is revalidated with a single stream view query, instead of querying the types and creating the stream views again.
+    The cache is only written once every stream view is in place, so a partial set of stream views is never reused."""
+
+    if use_cache and cache_file:
+        cached = cached_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, cache_file, mapping_rules)
+        if cached is not None:
+            return cached[0]
+
+    cache_key = stream_view_cache_key(adapter_type, namespace_id, mapping_rules)
+    search_query = stream_view_search_query(adapter_type, mapping_rules)
+
+    stream_views = find_stream_views(adapter_type, adh_client, namespace_id, mapping_rules)
+    needed_mapping = {stream_view.SourceTypeId: {'StreamViewId': stream_view.Id, 'TargetTypeId': stream_view.TargetTypeId} for stream_view in stream_views}
+
+    # Before creating the stream views, user confirmation is requested. Their list is only offered when the user is prompted
+    if not test and confirm(test, 'Would you like to see their IDs?', f'Found {len(stream_views)} types that are potentially going to be have stream views created to map existing types to them.'):
+        for stream_view in stream_views:
+            output(logging.INFO, stream_view.TargetTypeId)
+
+    if confirm(test, 'Would you like to create the stream views?'):
+
+        # Map each existing type id to the id of the stream view that maps it to the new type
+        mapping = {stream_view.SourceTypeId: stream_view.Id for stream_view in stream_views}
+
+        # Only the stream views that are not already on the namespace need to be created, which is checked with one bulk query
+        existing_stream_views = {stream_view.Id: stream_view for stream_view in get_all(adh_client.StreamViews.getStreamViews, namespace_id, search_query)}
+        provisioned_stream_views = provision_stream_views(adh_client, namespace_id, stream_views, existing_stream_views, max_concurrency)
+
+        # Cache the stream views once they are all known to be in place, so later runs can skip this step.
+        # If any failed, the next run tries to create them again rather than reusing the stream views that succeeded
+        if len(provisioned_stream_views) == len(stream_views):
+            save_stream_view_cache(cache_file, cache_key, needed_mapping)
+        else:
+            output(logging.WARNING, f'{len(stream_views) - len(provisioned_stream_views)} stream views could not be created, so the stream views are not cached. They will be created on the next run.')
         
         output(logging.INFO, 'Done creating stream views.')
 
     else:
         output(logging.INFO, 'Returning blank mapping table')
+        mapping = {}
         
     return mapping
 
-def main(test=False):
-    """This function is the main body of the SDS sample script"""
-    exception = None
+def provision_stream_views(adh_client, namespace_id, stream_views, existing_stream_views, max_concurrency=default_max_concurrency):
+    """Creates the given stream views concurrently, skipping those that already exist with the same source and target types.
+    Returns the stream views that are in place on the namespace afterwards"""
+
+    def create_stream_view(stream_view):
+        """Creates a single stream view, and returns it if successful"""
+        output(logging.INFO, f'Creating stream view with id {stream_view.Id} mapping {stream_view.SourceTypeId} to {stream_view.TargetTypeId}...')
+        try:
+            return call_with_retries(lambda: adh_client.StreamViews.getOrCreateStreamView(namespace_id, stream_view), f'the creation of stream view {stream_view.Id}')
+        except Exception as error:
+            # Log the error, but don't raise the exception. This failure is only a problem if it causes a stream to fail to convert, which will be caught later as a separate exception
+            output(logging.ERROR, f'Encountered error while creating stream view with id {stream_view.Id}: {error}')
+            output(logging.ERROR, f'This script will continue but may fail later when attempting to convert streams from {stream_view.SourceTypeId} to {stream_view.TargetTypeId}.')
+            return None
+
+    provisioned_stream_views = []
+    missing_stream_views = []
+    for stream_view in stream_views:
+        existing_stream_view = existing_stream_views.get(stream_view.Id)
+        if existing_stream_view is not None and existing_stream_view.SourceTypeId == stream_view.SourceTypeId and existing_stream_view.TargetTypeId == stream_view.TargetTypeId:
+            output(logging.INFO, f'Stream view with id {stream_view.Id} mapping {stream_view.SourceTypeId} to {stream_view.TargetTypeId} already exists.')
+            provisioned_stream_views.append(stream_view)
+        else:
+            missing_stream_views.append(stream_view)
+
+    if missing_stream_views:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            provisioned_stream_views.extend(stream_view for stream_view in executor.map(create_stream_view, missing_stream_views) if stream_view is not None)
+
+    return provisioned_stream_views
+
+def create_adaptive_concurrency(appsettings):
+    """Creates the adaptive concurrency limit configured in appsettings.json, with MaxConcurrency as its ceiling, or None if AdaptiveConcurrency is turned off"""
+    if not appsettings.get('AdaptiveConcurrency', True):
+        return None
+
+    return AdaptiveConcurrency(appsettings.get('MaxConcurrency', default_max_concurrency),
+                               appsettings.get('MinConcurrency', 1),
+                               appsettings.get('LatencyTolerance', default_latency_tolerance))
+
+def create_retry_policy(appsettings):
+    """Creates the retry policy of the stream type updates configured in appsettings.json"""
+    return RetryPolicy(appsettings.get('MaxRetries', default_retry_policy.MaxRetries),
+                       appsettings.get('RetryBaseDelaySeconds', default_retry_policy.BaseDelaySeconds),
+                       appsettings.get('RetryMaxDelaySeconds', default_retry_policy.MaxDelaySeconds))
+
+def create_mapping_rules(appsettings):
+    """Returns the compiled rules of the mapping rules file configured in appsettings.json for its adapter type, or None if MappingRulesFile is not set"""
+    mapping_rules_file = appsettings.get('MappingRulesFile')
+    if not mapping_rules_file:
+        return None
 
+    return load_mapping_rules(mapping_rules_file, appsettings.get('AdapterType'))
+
+def parse_shard(text):
+    """Parses a shard given as i/N, such as 2/4 for the second of four shards"""
+    index, separator, count = text.partition('/')
     try:
-        appsettings = get_appsettings()
+        shard = Shard(int(index), int(count))
+    except ValueError:
+        shard = None
 
-        # Read configuration from appsettings.json and create the ADH client object
-        output(logging.DEBUG, 'Authenticating to ADH...')
-        adh_client = ADHClient(appsettings.get('ApiVersion'),
-                                appsettings.get('TenantId'),
-                                appsettings.get('Resource'),
-                                appsettings.get('ClientId'),
-                                appsettings.get('ClientSecret'))
+    if not separator or shard is None or not 1 <= shard.Index <= shard.Count:
+        raise ValueError(f'The shard {text} is not of the form i/N, with i from 1 to N')
+
+    return shard
+
+def in_shard(stream_id, shard):
+    """Checks if a stream belongs to a shard (every stream does if the shard is None).
+    The streams are partitioned by the CRC-32 of their id, which unlike hash() is the same in every process and on every host, so the hosts need no coordination"""
+    return shard is None or zlib.crc32(stream_id.encode('utf-8')) % shard.Count == shard.Index - 1
+
+def create_shard(appsettings):
+    """Returns the shard of the streams configured as Shard in appsettings.json, or None if the streams are not sharded"""
+    shard = appsettings.get('Shard')
+    return parse_shard(shard) if shard else None
+
+def report_failed_streams(appsettings, namespace_id, failed_streams):
+    """Appends the streams that could not be converted to the failed streams file configured in appsettings.json (unless it is null), and logs where they were written"""
+    failed_streams_file = appsettings.get('FailedStreamsFile', default_failed_streams_file)
+    if not failed_streams or not failed_streams_file:
+        return
+
+    record_failed_streams(failed_streams_file, namespace_id, failed_streams)
+    transient = sum(1 for stream, stream_view_id, error in failed_streams if is_transient_error(error))
+    output(logging.WARNING, f'{len(failed_streams)} streams that could not be converted were written to {failed_streams_file}, '
+                            f'{len(failed_streams) - transient} of them with a permanent error and {transient} after running out of retries.')
 
-        namespace_id = appsettings.get('NamespaceId')
-        stream_search_query = appsettings.get('StreamSearchPattern')
+def convert_streams_with_journal(adh_client, appsettings, namespace_id, streams, type_to_stream_view_mappings, metrics=None, converted_since=None):
+    """Converts the given streams of a namespace, recording each outcome in the journal configured in appsettings.json.
+    converted_since is the time the type ids of the streams were read from ADH, if not just now, as for convert_streams.
+    The number of conversions in flight adapts to how hard ADH allows the sample to push it, and the streams that could not be converted are written to the failed streams file.
+    Returns the tally of the stream outcomes along with the last conversion error encountered (if any)"""
+    max_concurrency = appsettings.get('MaxConcurrency', default_max_concurrency)
+    concurrency = create_adaptive_concurrency(appsettings)
+    failed_streams = []
 
-        # Create a dictionary that maps the existing type name to the stream view id that maps that type to the corresponding new type
-        # Only a dictionary is needed to proceed, but the sample can generate its own for the adapter upgrade from 1.1 to 1.2. 
-        # Uncommented certain lines of code such that one type_to_stream_view_mappings object is created
+    # Record each stream's outcome in the journal, so that an interrupted run can pick up where it left off. Setting JournalFile to null disables this
+    journal_file = appsettings.get('JournalFile', default_journal_file)
+    journal = ConversionJournal(journal_file, namespace_id) if journal_file else None
 
-        ### Generic use case ###
-        """ type_to_stream_view_mappings = {
-                'existing_type1': 'stream_view_id1',
-                'existing_type2': 'stream_view_id2'
-            } """
-        # Note: the stream views will need to be created first, whether programmatically or through the ADH portal
+    try:
+        if journal is not None and journal.converted_count() > 0:
+            output(logging.INFO, f'Resuming from {journal_file}: {journal.converted_count()} streams recorded as converted will not be converted again while they stay converted.')
+
+        # Convert the streams across a pool of worker threads, keeping track of the streams processed and skipped
+        return convert_streams(adh_client, namespace_id, streams, type_to_stream_view_mappings, max_concurrency, journal, metrics,
+                               concurrency, create_retry_policy(appsettings), failed_streams, converted_since)
+
+    finally:
+        if journal is not None:
+            journal.close()
+
+        if concurrency is not None and concurrency.lowest_limit < max_concurrency:
+            output(logging.INFO, f'ADH pushed back during the conversions: the concurrency limit went as low as {concurrency.lowest_limit}, and ended at {concurrency.limit}.')
+
+        report_failed_streams(appsettings, namespace_id, failed_streams)
+
+def log_tally(tally):
+    """Logs the final tallies of each counter of the stream outcomes"""
+    converted_streams = tally['converted']
+    skipped_streams = tally['skipped']
+    failed_streams = tally['failed']
+    previously_converted_streams = tally['previously_converted']
+
+    if previously_converted_streams > 0:
+        output(logging.INFO, f'Passed over {previously_converted_streams} streams that were converted by a previous run.')
+
+    output(logging.INFO, f'Operation completed. Successfully converted {converted_streams} streams.')
+
+    # If a stream failed or was skipped, log it was a warning. Otherwise, log it as info
+    if failed_streams > 0 or skipped_streams > 0:
+        output(logging.WARNING, f'Operation incomplete. Failed to convert {failed_streams} streams and skipped {skipped_streams} streams.')
+    else:
+        output(logging.INFO, f'No streams failed to convert or were skipped.')
+
+def create_base_client(appsettings):
+    """Creates the pooled base client shared by every ADH client call, from the configuration read from appsettings.json.
+    By default the connection pool holds twice as many connections as there are conversion workers, so that the enumeration of the next page can run alongside them"""
+    return PooledBaseClient(appsettings.get('ApiVersion'),
+                            appsettings.get('TenantId'),
+                            appsettings.get('Resource'),
+                            appsettings.get('ClientId'),
+                            appsettings.get('ClientSecret'),
+                            appsettings.get('ConnectionPoolSize') or 2 * appsettings.get('MaxConcurrency', default_max_concurrency),
+                            appsettings.get('TokenRefreshIntervalSeconds', default_token_refresh_interval))
+
+def create_adh_client(appsettings, base_client=None):
+    """Creates the ADH client object from the configuration read from appsettings.json, sending its calls through the given pooled base client if any"""
+    if base_client is not None:
+        return ADHClient(appsettings.get('ApiVersion'), appsettings.get('TenantId'), appsettings.get('Resource'), appsettings.get('ClientId'), base_client=base_client)
+
+    return ADHClient(appsettings.get('ApiVersion'),
+                        appsettings.get('TenantId'),
+                        appsettings.get('Resource'),
+                        appsettings.get('ClientId'),
+                        appsettings.get('ClientSecret'))
+
+def migrate_namespace(adh_client, appsettings, namespace_id, test, metrics=None):
+    """Generates the type to stream view mappings for a namespace and converts the streams matching the stream search pattern.
+    If metrics are given, the progress of the conversions is tracked in them.
+    Returns the tally of the stream outcomes along with the last conversion error encountered (if any), or None for both if the user chose not to continue"""
+    stream_search_query = appsettings.get('StreamSearchPattern')
 
-        ### Adapter 1.1 to 1.2 upgrade use case ###
-        type_to_stream_view_mappings = generate_adapter_upgrade_mappings(appsettings.get('AdapterType'), adh_client, namespace_id, test)
+    # Create a dictionary that maps the existing type name to the stream view id that maps that type to the corresponding new type
+    # Only a dictionary is needed to proceed, but the sample can generate its own for the adapter upgrade from 1.1 to 1.2,
+    # either by its naming convention or by the rules of the mapping rules file (see mapping_rules.sample.json).
+    # Uncommented certain lines of code such that one type_to_stream_view_mappings object is created
 
-        # Get streams in the namespace
-        streams = adh_client.Streams.getStreams(namespace_id, query=stream_search_query)
+    ### Generic use case ###
+    """ type_to_stream_view_mappings = {
+            'existing_type1': 'stream_view_id1',
+            'existing_type2': 'stream_view_id2'
+        } """
+    # Note: the stream views will need to be created first, whether programmatically or through the ADH portal
+
+    ### Adapter 1.1 to 1.2 upgrade use case ###
+    max_concurrency = appsettings.get('MaxConcurrency', default_max_concurrency)
+    stream_view_cache_file = appsettings.get('StreamViewCacheFile', default_stream_view_cache_file)
+    adapter_type = appsettings.get('AdapterType')
+    mapping_rules = create_mapping_rules(appsettings)
+
+    # A cached mapping table is reused without querying the types on the namespace, so it is checked against the types of the streams once they are known
+    cached = cached_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, stream_view_cache_file, mapping_rules) if stream_view_cache_file else None
+    if cached is not None:
+        type_to_stream_view_mappings, cached_target_type_ids = cached
+    else:
+        type_to_stream_view_mappings = generate_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, test, max_concurrency, stream_view_cache_file, mapping_rules, use_cache=False)
+        cached_target_type_ids = None
+
+    def regenerate_if_uncovered(type_ids):
+        """Generates the mappings again if some of the given types are not covered by the cached mapping table, such as types added by the adapter since it was cached.
+        Returns whether they were generated again"""
+        nonlocal type_to_stream_view_mappings, cached_target_type_ids
+        if cached_target_type_ids is None:
+            return False
+
+        new_type_ids = uncovered_type_ids(type_ids, type_to_stream_view_mappings, cached_target_type_ids)
+        cached_target_type_ids = None
+        if not new_type_ids:
+            return False
+
+        output(logging.INFO, f'Found streams on {len(new_type_ids)} types that the cached stream views do not cover, such as {new_type_ids[0]}. The stream views will be regenerated.')
+        type_to_stream_view_mappings = generate_adapter_upgrade_mappings(adapter_type, adh_client, namespace_id, test, max_concurrency, stream_view_cache_file, mapping_rules, use_cache=False)
+        return True
+
+    page_size = appsettings.get('PageSize', default_page_size)
+    enumeration_mode = appsettings.get('EnumerationMode', 'List')
+
+    # With the PerType query strategy, ADH is queried once per existing type in the mappings, so the streams that would be skipped are never transferred
+    per_type_queries = appsettings.get('QueryStrategy', 'Pattern').lower() == 'pertype'
+    skipped_streams = Counter()
+
+    # When the migration is split across several hosts, only the streams of this host's shard are converted
+    shard = create_shard(appsettings)
+    if shard is not None:
+        output(logging.INFO, f'Converting only the streams of shard {shard.Index}/{shard.Count} of namespace {namespace_id}.')
+
+    if per_type_queries and appsettings.get('ReportSkipped', False):
+        # The skipped streams are only counted on request, as this pages through them with one more query
+        skipped_streams = count_skipped_streams(adh_client, namespace_id, stream_search_query, list(type_to_stream_view_mappings), page_size, shard)
+        if regenerate_if_uncovered(skipped_streams):
+            skipped_streams = count_skipped_streams(adh_client, namespace_id, stream_search_query, list(type_to_stream_view_mappings), page_size, shard)
+        for type_id, count in skipped_streams.items():
+            output(logging.WARNING, f'Skipping {count} streams of type {type_id}, because this type is not in the mappings table')
+
+    # Converting a stream removes it from the results of its type's query, so the per type queries are always read in full before converting
+    if enumeration_mode.lower() == 'streaming' and not per_type_queries:
+        # Streams are converted page by page as they are enumerated, so their total count is not known ahead of time.
+        # Before changing the streams, user confirmation is requested
+        if not confirm(test, 'Would you like to continue with the type conversions?',
+                       f'Streams matching the stream search pattern of {stream_search_query} will be converted using stream view as they are found.'):
+            output(logging.INFO, 'Exiting. No transformation will be attempted.')
+            return None, None
+
+        # Flatten the pages into one lazy sequence of stream records for the converter to pull from
+        streams = (stream for page in enumerate_streams(adh_client, namespace_id, stream_search_query, page_size) for stream in page if in_shard(stream.Id, shard))
+
+    else:
+        # Get streams in the namespace, keeping only their ids (and names for display) in a catalog grouped by type
+        if per_type_queries:
+            streams = enumerate_streams_per_type(adh_client, namespace_id, stream_search_query, list(type_to_stream_view_mappings), page_size, max_concurrency)
+        else:
+            streams = StreamCatalog()
+            for page in enumerate_streams(adh_client, namespace_id, stream_search_query, page_size, compact=False):
+                streams.extend(page)
+            regenerate_if_uncovered(streams.type_ids())
 
         if len(streams) == 0:
-            message = f'No stream found on namespace {namespace_id} that match the stream search pattern of {stream_search_query}'
-            output(logging.ERROR, message)
-            output(logging.ERROR, 'Quitting script...')
-            raise Exception(message)
-
-        if test:
-            # If this script is being E2E tested, presume the user input to be y
-            response = 'y'
-            output(logging.DEBUG, f'Automated test will begin type conversion without prompting the user, assuming a response of {response}.')
-
-        else: 
-            # Before changing the streams, user confirmation is requested
-            print()
-            output(logging.INFO, f'Found {len(streams)} streams that are potentially going to be converted using stream view.')
-            print()
-            logging.debug(f'Prompting user whether they would like to see the list of stream IDs.')
-            response = input('Would you like to see their IDs? (y/n): ')
-            logging.debug(f'Response: {response}')
-            print()
-
-            if affirmative_response(response):
-                for stream in streams:
-                    output(logging.INFO, f'ID: {stream.Id} Name: {stream.Name}')
-
-            print()
-            logging.debug(f'Prompting user whether they would like to continue with the stream type edits.')
-            response = input('Would you like to continue with the type conversions? (y/n): ')
-            logging.debug(f'Response: {response}')
-            print()
-
-        if affirmative_response(response):
-
-            output(logging.INFO, 'Processing streams...')
-            
-            # Keep track of the streams processed and skipped
-            converted_streams = 0
-            skipped_streams = 0
-            failed_streams = 0
+            raise_no_streams_found(namespace_id, stream_search_query)
+
+        if shard is not None:
+            # The stream search pattern matched streams, so a shard without any of them is not an error
+            streams = streams.where(lambda stream_id: in_shard(stream_id, shard))
+
+        if metrics is not None:
+            metrics.set_total_streams(len(streams))
 
+        # Before changing the streams, user confirmation is requested. Their list is only offered when the user is prompted
+        if not test and confirm(test, 'Would you like to see their IDs?', f'Found {len(streams)} streams that are potentially going to be converted using stream view.'):
             for stream in streams:
+                output(logging.INFO, f'ID: {stream.Id} Name: {streams.name(stream.Id)}')
 
-                # Look for the stream's existing type in the mappings table. If it's there, apply the stream view
-                if stream.TypeId in type_to_stream_view_mappings:
-                    output(logging.INFO, f'Changing type of {stream.Id} away from {stream.TypeId} using steamview id {type_to_stream_view_mappings[stream.TypeId]}...')
-                    try:
-                        adh_client.Streams.updateStreamType(namespace_id, stream_id=stream.Id, stream_view_id=type_to_stream_view_mappings[stream.TypeId])
-                        converted_streams += 1
-                    except Exception as error:
-                        output(logging.ERROR, f'Encountered error while converting stream: {error}')
-                        exception = error
-                        failed_streams += 1
+        if not confirm(test, 'Would you like to continue with the type conversions?'):
+            output(logging.INFO, 'Exiting. No transformation will be attempted.')
+            return None, None
+
+    output(logging.INFO, 'Processing streams...')
+    tally, conversion_exception = convert_streams_with_journal(adh_client, appsettings, namespace_id, streams, type_to_stream_view_mappings, metrics)
+    tally['skipped'] += sum(skipped_streams.values())
+
+    # In streaming mode, an empty search result is only discovered once the enumeration is done. A shard of a small namespace may be empty on its own
+    if sum(tally.values()) == 0 and shard is None:
+        raise_no_streams_found(namespace_id, stream_search_query)
+
+    log_tally(tally)
+
+    return tally, conversion_exception
+
+def create_migration_plan(adh_client, appsettings, namespace_id, plan_file):
+    """Plans the migration of a namespace without making any changes to it: the streams matching the stream search pattern are enumerated
+    and indexed by their type id, and written to the plan file along with the stream views needed to convert them and summary counts.
+    Returns the summary of the plan"""
+    adapter_type = appsettings.get('AdapterType')
+    stream_search_query = appsettings.get('StreamSearchPattern')
+    page_size = appsettings.get('PageSize', default_page_size)
+
+    # Work out the stream views needed for the adapter upgrade, without creating them
+    stream_views = find_stream_views(adapter_type, adh_client, namespace_id, create_mapping_rules(appsettings))
+    type_to_stream_view_mappings = {stream_view.SourceTypeId: stream_view.Id for stream_view in stream_views}
+
+    # Index the stream ids by their existing type id
+    output(logging.INFO, f'Enumerating the streams matching the stream search pattern of {stream_search_query}...')
+    catalog = StreamCatalog()
+    for page in enumerate_streams(adh_client, namespace_id, stream_search_query, page_size):
+        catalog.extend(page)
+
+    if len(catalog) == 0:
+        raise_no_streams_found(namespace_id, stream_search_query)
+
+    # The mappings table is consulted once per type
+    type_counts = catalog.counts()
+    convertible_streams = sum(count for type_id, count in type_counts.items() if type_id in type_to_stream_view_mappings)
+    summary = {
+        'Streams': len(catalog),
+        'Convertible': convertible_streams,
+        'Skipped': len(catalog) - convertible_streams,
+        'Types': {type_id: {'Streams': count, 'StreamViewId': type_to_stream_view_mappings.get(type_id)} for type_id, count in type_counts.items()}
+    }
+
+    # The first line of the plan describes it as a whole, and each following line holds a chunk of the stream ids of one type
+    with open(plan_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({
+            'NamespaceId': namespace_id,
+            'AdapterType': adapter_type,
+            'StreamSearchPattern': stream_search_query,
+            'CreatedDate': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'StreamViews': [{'Id': stream_view.Id, 'SourceTypeId': stream_view.SourceTypeId, 'TargetTypeId': stream_view.TargetTypeId}
+                            for stream_view in stream_views if stream_view.SourceTypeId in type_counts],
+            'Summary': summary
+        }) + '\n')
+
+        for type_id in catalog.type_ids():
+            stream_ids = catalog.stream_ids(type_id)
+            for start in range(0, len(stream_ids), plan_chunk_size):
+                f.write(json.dumps({'TypeId': type_id, 'StreamViewId': type_to_stream_view_mappings.get(type_id), 'StreamIds': stream_ids[start:start + plan_chunk_size]}) + '\n')
+
+    log_plan_summary(summary)
+    output(logging.INFO, f'Migration plan for namespace {namespace_id} written to {plan_file}. No changes were made to the namespace.')
+    return summary
+
+def log_plan_summary(summary):
+    """Logs the summary counts of a migration plan"""
+    output(logging.INFO, f'The plan covers {summary["Streams"]} streams: {summary["Convertible"]} will be converted and {summary["Skipped"]} will be skipped.')
+    for type_id, type_summary in summary['Types'].items():
+        if type_summary['StreamViewId'] is not None:
+            output(logging.INFO, f'    {type_id}: {type_summary["Streams"]} streams will be converted using stream view {type_summary["StreamViewId"]}')
+        else:
+            output(logging.WARNING, f'    {type_id}: {type_summary["Streams"]} streams will be skipped, because this type is not in the mappings table')
+
+def read_migration_plan(plan_file):
+    """Reads the header of a migration plan, and returns it along with a generator of the stream id chunks that follow it.
+    The chunks are read from the file lazily, so a plan of any size can be streamed through the converter. The file is only opened again
+    once the chunks are iterated, so it is not left open if they never are, such as when the user chooses not to continue"""
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+
+    def read_chunks():
+        with open(plan_file, 'r', encoding='utf-8') as f:
+            # skip the header
+            f.readline()
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    return header, read_chunks()
+
+def execute_migration_plan(adh_client, appsettings, plan_file, test, metrics=None, namespace_results=None):
+    """Executes a migration plan written by create_migration_plan, converting the planned streams without enumerating the namespace again.
+    If a shard is configured, only the planned streams of that shard are converted, so one plan can be executed by several hosts.
+    If namespace_results is given, the tally and error (if any) of the namespace are stored in it by namespace id.
+    Returns the tally of the stream outcomes along with the last conversion error encountered (if any), or None for both if the user chose not to continue"""
+    header, chunks = read_migration_plan(plan_file)
+    namespace_id = header['NamespaceId']
+    summary = header['Summary']
+
+    output(logging.INFO, f'Executing the migration plan in {plan_file} for namespace {namespace_id}, created on {header["CreatedDate"]}.')
+    log_plan_summary(summary)
+
+    # Before changing the streams, user confirmation is requested
+    if not confirm(test, 'Would you like to continue with the planned type conversions?'):
+        output(logging.INFO, 'Exiting. No transformation will be attempted.')
+        return None, None
+
+    # Make sure the planned stream views are in place, creating any that are missing with one bulk query and concurrent creations
+    stream_views = [SdsStreamView(id=stream_view['Id'], source_type_id=stream_view['SourceTypeId'], target_type_id=stream_view['TargetTypeId']) for stream_view in header['StreamViews']]
+    search_query = stream_view_search_query(header['AdapterType'], create_mapping_rules(appsettings))
+    existing_stream_views = {stream_view.Id: stream_view for stream_view in get_all(adh_client.StreamViews.getStreamViews, namespace_id, search_query)}
+    provision_stream_views(adh_client, namespace_id, stream_views, existing_stream_views, appsettings.get('MaxConcurrency', default_max_concurrency))
+    type_to_stream_view_mappings = {stream_view.SourceTypeId: stream_view.Id for stream_view in stream_views}
+
+    # The share of each shard is only known as the plan is read, so the total is only set for an unsharded run
+    shard = create_shard(appsettings)
+    if shard is not None:
+        output(logging.INFO, f'Converting only the planned streams of shard {shard.Index}/{shard.Count}.')
+    elif metrics is not None:
+        metrics.set_total_streams(summary['Convertible'])
+
+    skipped_streams = Counter()
+
+    def planned_streams():
+        """Yields the streams planned for conversion, counting the skipped ones. The skipped streams were already reported when the plan was written"""
+        for chunk in chunks:
+            stream_ids = [stream_id for stream_id in chunk['StreamIds'] if in_shard(stream_id, shard)]
+            if chunk['StreamViewId'] is None:
+                skipped_streams[chunk['TypeId']] += len(stream_ids)
+            else:
+                yield from (StreamRecord(stream_id, chunk['TypeId']) for stream_id in stream_ids)
+
+    output(logging.INFO, 'Processing streams...')
+    # The type ids in the plan are those the streams had when it was written, so a journal entry for a stream on its planned type is only trusted
+    # if it was recorded after the plan, such as by an interrupted execution of this plan
+    tally, conversion_exception = convert_streams_with_journal(adh_client, appsettings, namespace_id, planned_streams(), type_to_stream_view_mappings, metrics,
+                                                               datetime.datetime.fromisoformat(header['CreatedDate']))
+    tally['skipped'] += sum(skipped_streams.values())
+
+    log_tally(tally)
+    if namespace_results is not None:
+        namespace_results[namespace_id] = (dict(tally), str(conversion_exception) if conversion_exception is not None else None)
+
+    return tally, conversion_exception
+
+def watch_namespace(adh_client, appsettings, namespace_id, test, metrics=None):
+    """Watches a namespace for new streams on the existing types, such as those created by adapters that have not been restarted since the migration,
+    and converts them as they appear. Each cycle only asks ADH for the streams still on an existing type, and only converts the ones not already seen by the watch,
+    so the cost of a cycle follows the number of new streams rather than the size of the namespace.
+    Runs until interrupted, or for WatchMaxCycles cycles if set. Returns the tally of the stream outcomes across all cycles along with the last conversion error encountered (if any)"""
+    stream_search_query = appsettings.get('StreamSearchPattern')
+    page_size = appsettings.get('PageSize', default_page_size)
+    max_concurrency = appsettings.get('MaxConcurrency', default_max_concurrency)
+    interval = appsettings.get('WatchIntervalSeconds', default_watch_interval)
+    max_cycles = appsettings.get('WatchMaxCycles')
+
+    # The stream views are generated (or read from the cache) once, when the watch starts
+    stream_view_cache_file = appsettings.get('StreamViewCacheFile', default_stream_view_cache_file)
+    type_to_stream_view_mappings = generate_adapter_upgrade_mappings(appsettings.get('AdapterType'), adh_client, namespace_id, test, max_concurrency, stream_view_cache_file,
+                                                                     create_mapping_rules(appsettings))
+    if not type_to_stream_view_mappings:
+        raise Exception(f'There are no existing types to watch for in namespace {namespace_id}.')
+
+    # Narrowing the query to the existing types means converted streams drop out of the results, so only the streams still waiting for conversion are returned
+    query = type_id_query(stream_search_query, type_to_stream_view_mappings)
+
+    # Before changing the streams, user confirmation is requested once for the whole watch
+    if not confirm(test, 'Would you like to start watching?', f'Streams matching {query} will be converted using stream view as they appear, every {interval} seconds until interrupted.'):
+        output(logging.INFO, 'Exiting. No transformation will be attempted.')
+        return None, None
+
+    # The index of the streams already handled by this watch, by Id, along with the type they had at the time.
+    # A stream that failed to convert keeps its existing type, so it is not attempted again unless its type changes or the watch is restarted
+    seen_streams = {}
+    tally = Counter()
+    last_exception = None
+
+    journal_file = appsettings.get('JournalFile', default_journal_file)
+    journal = ConversionJournal(journal_file, namespace_id) if journal_file else None
+
+    # The adaptive concurrency limit carries over from one cycle to the next
+    concurrency = create_adaptive_concurrency(appsettings)
+    retry_policy = create_retry_policy(appsettings)
+
+    try:
+        cycle = 0
+        while max_cycles is None or cycle < max_cycles:
+            if cycle > 0:
+                time.sleep(interval)
+            cycle += 1
+
+            try:
+                # The results are read in full before converting, as each conversion removes a stream from the query and would shift the later pages
+                streams = [stream for page in enumerate_streams(adh_client, namespace_id, query, page_size) for stream in page]
+                new_streams = [stream for stream in streams if seen_streams.get(stream.Id) != stream.TypeId]
+
+                if new_streams:
+                    output(logging.INFO, f'Found {len(new_streams)} new streams to convert.')
+                    failed_streams = []
+                    cycle_tally, conversion_exception = convert_streams(adh_client, namespace_id, new_streams, type_to_stream_view_mappings, max_concurrency, journal, metrics,
+                                                                        concurrency, retry_policy, failed_streams)
+                    report_failed_streams(appsettings, namespace_id, failed_streams)
+                    seen_streams.update((stream.Id, stream.TypeId) for stream in new_streams)
+                    tally.update(cycle_tally)
+                    log_tally(cycle_tally)
+
+                    if conversion_exception is not None:
+                        last_exception = conversion_exception
 
-                # If it's not, skip it and notify the user why it wasn't processed
                 else:
-                    output(logging.WARNING, f'Skipped {stream.Id} because it has a type of {stream.TypeId}, which is not in the mappings table. It will need to be migrated separately.')
-                    skipped_streams += 1
-
-            # Log the final tallies of each counter  
-            output(logging.INFO, f'Operation completed. Successfully converted {converted_streams} streams.')
-            
-            # If a stream failed or was skipped, log it was a warning. Otherwise, log it as info
-            if failed_streams > 0 or skipped_streams > 0:
-                output(logging.WARNING, f'Operation incomplete. Failed to convert {failed_streams} streams and skipped {skipped_streams} streams.')
+                    output(logging.DEBUG, f'No new streams found, {len(streams)} streams are still on an existing type.')
+
+            except Exception as error:
+                # A failed cycle, such as from a network outage, is retried on the next cycle rather than ending the watch
+                output(logging.ERROR, f'Watch cycle {cycle} failed, and will be retried: {error}')
+                last_exception = error
+
+    except KeyboardInterrupt:
+        output(logging.INFO, 'Stopped watching.')
+
+    finally:
+        if journal is not None:
+            journal.close()
+
+    output(logging.INFO, f'Watched {cycle} cycles: converted {tally["converted"]} streams and failed to convert {tally["failed"]} streams.')
+    return tally, last_exception
+
+def verify_namespace(adh_client, appsettings, namespace_id, report_file):
+    """Verifies the migration of a namespace by enumerating the streams matching the stream search pattern again, several pages at a time,
+    and comparing the current type of each against the type it is expected to have been converted to. No changes are made to the namespace.
+    The streams are classed as converted, unchanged (still on an existing type), unexpected (on any other type than expected), or unmapped
+    (on a type the migration does not cover), and the diff is written to the report file as JSON. Returns the summary counts"""
+    adapter_type = appsettings.get('AdapterType')
+    stream_search_query = appsettings.get('StreamSearchPattern')
+    page_size = appsettings.get('PageSize', default_page_size)
+    max_concurrency = appsettings.get('MaxConcurrency', default_max_concurrency)
+
+    # The type each existing type is expected to have been converted to
+    stream_views = find_stream_views(adapter_type, adh_client, namespace_id, create_mapping_rules(appsettings))
+    expected_type_ids = {stream_view.SourceTypeId: stream_view.TargetTypeId for stream_view in stream_views}
+    target_type_ids = set(expected_type_ids.values())
+
+    # Where the journal records the type a stream had before it was converted, the stream is held to the target of that type exactly
+    journal_file = appsettings.get('JournalFile', default_journal_file)
+    journal = ConversionJournal.read(journal_file, namespace_id) if journal_file and os.path.exists(journal_file) else None
+
+    converted = defaultdict(list)
+    unchanged = defaultdict(list)
+    unexpected = []
+    unmapped = defaultdict(list)
+
+    # Nothing is converting the streams while they are verified, so several pages can safely be requested at once
+    output(logging.INFO, f'Verifying the streams matching the stream search pattern of {stream_search_query}...')
+    for page in enumerate_streams(adh_client, namespace_id, stream_search_query, page_size, pages_in_flight=max_concurrency):
+        for stream in page:
+            original_type_id = journal.original_type_id(stream.Id) if journal is not None else None
+
+            if original_type_id is not None and stream.TypeId != original_type_id:
+                expected_type_id = expected_type_ids.get(original_type_id)
+                if stream.TypeId == expected_type_id:
+                    converted[stream.TypeId].append(stream.Id)
+                else:
+                    unexpected.append({'StreamId': stream.Id, 'TypeId': stream.TypeId, 'OriginalTypeId': original_type_id, 'ExpectedTypeId': expected_type_id})
+
+            elif stream.TypeId in target_type_ids:
+                converted[stream.TypeId].append(stream.Id)
+
+            elif stream.TypeId in expected_type_ids:
+                unchanged[stream.TypeId].append(stream.Id)
+
             else:
-                output(logging.INFO, f'No streams failed to convert or were skipped.')
+                unmapped[stream.TypeId].append(stream.Id)
+
+    summary = {
+        'Converted': sum(len(stream_ids) for stream_ids in converted.values()),
+        'Unchanged': sum(len(stream_ids) for stream_ids in unchanged.values()),
+        'Unexpected': len(unexpected),
+        'Unmapped': sum(len(stream_ids) for stream_ids in unmapped.values())
+    }
+    summary['Streams'] = sum(summary.values())
+
+    if summary['Streams'] == 0:
+        raise_no_streams_found(namespace_id, stream_search_query)
+
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'NamespaceId': namespace_id,
+            'AdapterType': adapter_type,
+            'StreamSearchPattern': stream_search_query,
+            'CreatedDate': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'Summary': summary,
+            'Converted': converted,
+            'Unchanged': {type_id: {'ExpectedTypeId': expected_type_ids[type_id], 'StreamIds': stream_ids} for type_id, stream_ids in unchanged.items()},
+            'Unexpected': unexpected,
+            'Unmapped': unmapped
+        }, f, indent=2)
+
+    output(logging.INFO, f'Verified {summary["Streams"]} streams: {summary["Converted"]} converted, {summary["Unchanged"]} unchanged, '
+                         f'{summary["Unexpected"]} on an unexpected type, and {summary["Unmapped"]} on a type not in the mappings table.')
+    if summary['Unchanged'] > 0 or summary['Unexpected'] > 0:
+        output(logging.WARNING, f'Not every stream has the expected type. See {report_file} for the streams concerned.')
+    else:
+        output(logging.INFO, f'Every stream has the expected type. The report was written to {report_file}.')
+
+    return summary
+
+def shard_file(path, shard):
+    """Derives a per-shard file name from a configured file name (eg. journal.jsonl -> journal.2of4.jsonl),
+    so that several shards run on the same host never write to the same file"""
+    if not path or shard is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{shard.Index}of{shard.Count}{extension}'
+
+def namespace_file(path, namespace_id):
+    """Derives a per-namespace file name from a configured file name (eg. journal.jsonl -> journal.<namespace_id>.jsonl),
+    so that the worker processes of a fan-out never write to the same file"""
+    if not path:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{namespace_id}{extension}'
+
+# The logging pipeline of the script, when it is run from the command line
+log_pipeline = None
+
+# The ADH client, its pooled base client, and the settings of a namespace worker process. They are set up once per process by init_namespace_worker, and shared by every namespace it migrates
+worker_adh_client = None
+worker_base_client = None
+worker_appsettings = None
+
+def init_namespace_worker(appsettings, log_level, log_file_name):
+    """Sets up a namespace worker process by configuring its logging and authenticating its ADH client.
+    The worker is a fresh process rather than a fork of the parent, so it has its own logging pipeline writing to the same log file"""
+    global worker_adh_client, worker_base_client, worker_appsettings
+
+    if log_file_name is not None:
+        log_pipeline = LogPipeline(log_file_name, log_level)
+        Finalize(log_pipeline, log_pipeline.stop, exitpriority=10)
+
+    worker_appsettings = appsettings
+    worker_base_client = create_base_client(appsettings)
+    worker_adh_client = create_adh_client(appsettings, worker_base_client)
+
+def migrate_namespace_in_worker(namespace_id):
+    """Migrates one namespace in a namespace worker process without prompting the user.
+    Returns the namespace id, the tally of the stream outcomes, the error encountered (if any) as a string, and the raw metrics of the namespace,
+    so they can be sent back to the parent process"""
+    appsettings = dict(worker_appsettings)
+    appsettings['JournalFile'] = namespace_file(appsettings.get('JournalFile', default_journal_file), namespace_id)
+    appsettings['StreamViewCacheFile'] = namespace_file(appsettings.get('StreamViewCacheFile', default_stream_view_cache_file), namespace_id)
+    appsettings['FailedStreamsFile'] = namespace_file(appsettings.get('FailedStreamsFile', default_failed_streams_file), namespace_id)
+
+    # Each namespace is measured separately, and its metrics are merged into those of the parent process.
+    # The connection pool is shared by the namespaces of the worker, so only the connection statistics added during this namespace are counted
+    metrics = ApiMetrics()
+    initial_connection_stats = Counter(worker_base_client.connection_stats())
+    metrics.track_connections(lambda: Counter(worker_base_client.connection_stats()) - initial_connection_stats)
+
+    try:
+        output(logging.INFO, f'Migrating namespace {namespace_id}...')
+        tally, exception = migrate_namespace(InstrumentedADHClient(worker_adh_client, metrics), appsettings, namespace_id, True, metrics)
+        return namespace_id, dict(tally or {}), str(exception) if exception is not None else None, metrics.state()
+
+    except Exception as error:
+        output(logging.ERROR, f'Encountered Error on namespace {namespace_id}: {error}')
+        return namespace_id, {}, str(error), metrics.state()
+
+def fan_out_namespaces(adh_client, appsettings, namespace_ids, test, metrics=None, namespace_results=None):
+    """Migrates each of the given namespaces in a pool of worker processes, so the total run time is bounded by the slowest namespace.
+    A namespace id of '*' stands for every namespace of the tenant. Logs an aggregated summary and returns the last error encountered (if any).
+    If metrics are given, the metrics of each namespace are merged into them as the namespace completes,
+    and if namespace_results is given, the tally and error (if any) of each namespace are stored in it by namespace id"""
+
+    if '*' in namespace_ids:
+        namespace_ids = [namespace.Id for namespace in adh_client.Namespaces.getNamespaces()]
+
+    if len(namespace_ids) == 0:
+        message = f'No namespaces were found to migrate on tenant {appsettings.get("TenantId")}'
+        output(logging.ERROR, message)
+        raise Exception(message)
+
+    # The worker processes cannot prompt the user, so confirmation for every namespace is requested up front
+    if not confirm(test, 'Would you like to create the stream views and convert the streams on each of these namespaces without further prompts?',
+                   f'Found {len(namespace_ids)} namespaces to migrate: {", ".join(namespace_ids)}'):
+        output(logging.INFO, 'Exiting. No transformation will be attempted.')
+        return None
+
+    max_workers = appsettings.get('MaxNamespaceWorkers') or min(len(namespace_ids), os.cpu_count() or 1)
+    if log_pipeline is not None:
+        log_file_name = log_pipeline.log_file_name
+    else:
+        log_file_name = next((handler.baseFilename for handler in logging.getLogger().handlers if isinstance(handler, logging.FileHandler)), None)
+
+    totals = Counter(converted=0, skipped=0, failed=0, previously_converted=0)
+    failed_namespaces = []
+    exception = None
+
+    # The worker processes are spawned rather than forked, as the parent is already running the threads of the logging pipeline, the progress reporter,
+    # and the token refresh, and forking a process with running threads can deadlock the child on a lock held by one of them
+    output(logging.INFO, f'Migrating {len(namespace_ids)} namespaces using {max_workers} worker processes...')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_namespace_worker,
+                             initargs=(appsettings, logging.getLogger().level, log_file_name)) as executor:
+        for future in as_completed([executor.submit(migrate_namespace_in_worker, namespace_id) for namespace_id in namespace_ids]):
+            namespace_id, tally, error, namespace_metrics = future.result()
+            totals.update(tally)
+            if metrics is not None:
+                metrics.merge(namespace_metrics)
+            if namespace_results is not None:
+                namespace_results[namespace_id] = (tally, error)
+
+            output(logging.INFO, f'Namespace {namespace_id}: converted {tally.get("converted", 0)}, skipped {tally.get("skipped", 0)}, failed {tally.get("failed", 0)}, previously converted {tally.get("previously_converted", 0)} streams.')
+            if error is not None:
+                output(logging.ERROR, f'Namespace {namespace_id} encountered an error: {error}')
+                failed_namespaces.append(namespace_id)
+                exception = Exception(f'Namespace {namespace_id}: {error}')
+
+    # Log the aggregated tallies across every namespace
+    output(logging.INFO, f'Fan-out completed across {len(namespace_ids)} namespaces. Successfully converted {totals["converted"]} streams, and passed over {totals["previously_converted"]} streams converted by a previous run.')
+    if totals['failed'] > 0 or totals['skipped'] > 0 or failed_namespaces:
+        output(logging.WARNING, f'Fan-out incomplete. Failed to convert {totals["failed"]} streams and skipped {totals["skipped"]} streams. Namespaces with errors: {", ".join(failed_namespaces) or "none"}.')
+    else:
+        output(logging.INFO, f'No streams failed to convert or were skipped on any namespace.')
+
+    return exception
+
+def write_shard_summary(summary_file, shard, namespace_results, exception=None):
+    """Writes the summary of a shard, holding the tally and error (if any) of each namespace it migrated, for the merge mode to combine with the other shards"""
+    with open(summary_file, 'w') as f:
+        json.dump({
+            'Shard': f'{shard.Index}/{shard.Count}',
+            'CompletedDate': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'Namespaces': {namespace_id: {'Tally': tally, 'Error': error} for namespace_id, (tally, error) in namespace_results.items()},
+            'Error': str(exception) if exception is not None else None
+        }, f, indent=2)
+
+    output(logging.INFO, f'Summary of shard {shard.Index}/{shard.Count} written to {summary_file}')
+
+def merge_shard_summaries(summary_files, merged_summary_file):
+    """Combines the summaries written by the shards of a migration into one overall tally per namespace and in total, and writes it to the merged summary file.
+    Reports the shards that are missing or were given more than once, and the errors encountered by any shard. Returns the merged summary"""
+    shards = {}
+    for summary_file in summary_files:
+        with open(summary_file, 'r') as f:
+            summary = json.load(f)
+
+        if 'Shard' not in summary:
+            output(logging.WARNING, f'{summary_file} is not the summary of a shard, and is left out of the merge.')
+            continue
+
+        shard = parse_shard(summary['Shard'])
+        if shard in shards:
+            output(logging.WARNING, f'Shard {summary["Shard"]} was given more than once. Only the summary in {summary_file} is merged.')
+        shards[shard] = summary
+
+    if not shards:
+        raise Exception('There are no shard summaries to merge.')
+
+    shard_counts = {shard.Count for shard in shards}
+    if len(shard_counts) > 1:
+        raise Exception(f'The summaries belong to migrations split into different numbers of shards ({", ".join(str(count) for count in sorted(shard_counts))}), and cannot be merged.')
+
+    shard_count = shard_counts.pop()
+    missing_shards = [f'{index}/{shard_count}' for index in range(1, shard_count + 1) if Shard(index, shard_count) not in shards]
+
+    totals = Counter(converted=0, skipped=0, failed=0, previously_converted=0)
+    namespace_tallies = defaultdict(Counter)
+    errors = []
+    for shard, summary in sorted(shards.items()):
+        for namespace_id, namespace_summary in summary['Namespaces'].items():
+            namespace_tallies[namespace_id].update(namespace_summary['Tally'])
+            totals.update(namespace_summary['Tally'])
+            if namespace_summary['Error'] is not None:
+                errors.append(f'Shard {shard.Index}/{shard.Count}, namespace {namespace_id}: {namespace_summary["Error"]}')
+        if summary.get('Error') is not None:
+            errors.append(f'Shard {shard.Index}/{shard.Count}: {summary["Error"]}')
+
+    merged_summary = {
+        'Shards': [f'{shard.Index}/{shard.Count}' for shard in sorted(shards)],
+        'MissingShards': missing_shards,
+        'Namespaces': {namespace_id: dict(tally) for namespace_id, tally in namespace_tallies.items()},
+        'Tally': dict(totals),
+        'Errors': errors
+    }
+
+    with open(merged_summary_file, 'w') as f:
+        json.dump(merged_summary, f, indent=2)
+
+    output(logging.INFO, f'Merged the summaries of {len(shards)} of {shard_count} shards across {len(namespace_tallies)} namespaces into {merged_summary_file}.')
+    log_tally(totals)
+    for error in errors:
+        output(logging.ERROR, error)
+    if missing_shards:
+        output(logging.WARNING, f'The summaries of shards {", ".join(missing_shards)} are missing, so the tally does not cover every stream.')
+
+    return merged_summary
+
+def export_metrics(metrics, metrics_file, prometheus_file):
+    """Logs a summary of the calls made to ADH, and writes the final metrics to the JSON and Prometheus files (if configured)"""
+    metrics.stop_exporting()
+
+    for operation, call_metrics in metrics.summary()['Calls'].items():
+        p50 = call_metrics['P50Seconds']
+        p99 = call_metrics['P99Seconds']
+        output(logging.INFO, f'{operation}: {call_metrics["Count"]} calls, {call_metrics["Errors"]} errors, mean {call_metrics["MeanSeconds"]}s, '
+                             f'p50 <= {p50 if p50 is not None else "+Inf"}s, p99 <= {p99 if p99 is not None else "+Inf"}s')
+
+    connections = metrics.connection_stats()
+    if connections.get('Requests'):
+        output(logging.INFO, f'Sent {connections["Requests"]} requests over {connections.get("ConnectionsOpened", 0)} connections, '
+                             f'reusing a pooled connection for {connections.get("ReusedConnections", 0)} of them. The bearer token was refreshed {connections.get("TokenRefreshes", 0)} times.')
+
+    try:
+        if metrics_file:
+            metrics.write_json(metrics_file)
+            output(logging.INFO, f'Metrics written to {metrics_file}')
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+    except Exception as error:
+        output(logging.WARNING, f'Could not write the metrics: {error}')
+
+def main(test=False, appsettings=None, namespace_ids=None, mode='convert', plan_file=None, shard=None, summary_file=None, summary_files=None):
+    """This function is the main body of the SDS sample script.
+    The settings are read from appsettings.json unless they are passed in, such as when running against the local fake ADH service.
+    In convert mode (the default), the stream views are created and the streams are converted in one pass.
+    In plan mode, a migration plan is written to the plan file without making any changes, and in execute mode that plan is carried out.
+    In watch mode, the namespace is polled for new streams on the existing types, which are converted as they appear.
+    In verify mode, the current type of every stream is checked against the type it is expected to have been converted to, and a report is written.
+    If several namespaces are given (or configured as NamespaceIds), each one is migrated in a pool of worker processes.
+    If a shard is given (or configured as Shard), the convert and execute modes only convert the streams of that shard, and write a summary for the merge mode,
+    which combines the summaries of the shards without connecting to ADH, and exits with a status of 1 if they cannot be merged"""
+    exception = None
+    metrics = None
+    base_client = None
+    namespace_results = {}
+
+    if mode == 'merge':
+        # The merge does not connect to ADH, so appsettings.json is optional, but its ShardSummaryFile still applies when there is one
+        if appsettings is None and os.path.exists('appsettings.json'):
+            appsettings = get_appsettings()
+        try:
+            merge_shard_summaries(summary_files or [], summary_file or (appsettings or {}).get('ShardSummaryFile', default_shard_summary_file))
+        except Exception as error:
+            output(logging.ERROR, f'Encountered Error: {error}')
+            if test:
+                raise
+            # The merge is usually scripted to run once every shard is done, so its failure is reported in the exit code
+            sys.exit(1)
+        return
+
+    try:
+        if appsettings is None:
+            appsettings = get_appsettings()
+
+        # A shard given on the command line takes precedence over the one in appsettings.json. Each shard keeps its own journal and failed streams file,
+        # so that several shards can run on the same host
+        if shard is not None:
+            appsettings = dict(appsettings, Shard=f'{shard.Index}/{shard.Count}')
+        shard = create_shard(appsettings)
+        if shard is not None:
+            if mode not in ('convert', 'execute'):
+                raise Exception(f'The {mode} mode works on every stream of the namespace, and cannot be combined with a shard.')
+
+            appsettings = dict(appsettings,
+                               JournalFile=shard_file(appsettings.get('JournalFile', default_journal_file), shard),
+                               FailedStreamsFile=shard_file(appsettings.get('FailedStreamsFile', default_failed_streams_file), shard))
+            summary_file = summary_file or shard_file(appsettings.get('ShardSummaryFile', default_shard_summary_file), shard)
+
+        # Every call to ADH is measured, and the metrics are written to MetricsFile at exit. They can also be exported to a Prometheus text file during the run
+        metrics = ApiMetrics()
+        metrics_file = appsettings.get('MetricsFile', default_metrics_file)
+        prometheus_file = appsettings.get('PrometheusFile')
+        if prometheus_file:
+            metrics.start_exporting(prometheus_file, appsettings.get('PrometheusIntervalSeconds', default_prometheus_interval))
+
+        # The console shows the progress of the conversions every few seconds, while the log file keeps a line per stream
+        metrics.start_reporting_progress(appsettings.get('ProgressIntervalSeconds', default_progress_interval))
+
+        # Read configuration from appsettings.json and create the ADH client object, whose calls share a pool of connections and a token refreshed in the background
+        output(logging.DEBUG, 'Authenticating to ADH...')
+        base_client = create_base_client(appsettings)
+        metrics.track_connections(base_client.connection_stats)
+        adh_client = InstrumentedADHClient(create_adh_client(appsettings, base_client), metrics)
+
+        if namespace_ids is None:
+            namespace_ids = appsettings.get('NamespaceIds')
+
+        if plan_file is None:
+            plan_file = appsettings.get('PlanFile', default_plan_file)
+
+        if mode != 'convert' and namespace_ids:
+            raise Exception(f'The {mode} mode works on a single namespace, and cannot be combined with several namespaces.')
+
+        if mode == 'plan':
+            create_migration_plan(adh_client, appsettings, appsettings.get('NamespaceId'), plan_file)
+
+        elif mode == 'execute':
+            tally, exception = execute_migration_plan(adh_client, appsettings, plan_file, test, metrics, namespace_results)
+
+        elif mode == 'verify':
+            verify_namespace(adh_client, appsettings, appsettings.get('NamespaceId'), appsettings.get('VerificationReportFile', default_verification_report_file))
+
+        elif mode == 'watch':
+            tally, exception = watch_namespace(adh_client, appsettings, appsettings.get('NamespaceId'), test, metrics)
+
+        elif namespace_ids:
+            # Fan out across several namespaces of the tenant, one worker process per namespace at a time
+            exception = fan_out_namespaces(adh_client, appsettings, namespace_ids, test, metrics, namespace_results)
 
         else:
-            output(logging.INFO, 'Exiting. No transformation will be attempted.')
+            tally, exception = migrate_namespace(adh_client, appsettings, appsettings.get('NamespaceId'), test, metrics)
+            if tally is not None:
+                namespace_results[appsettings.get('NamespaceId')] = (dict(tally), str(exception) if exception is not None else None)
 
     except Exception as error:
         output(logging.ERROR, f'Encountered Error: {error}')
@@ -239,6 +2287,20 @@ def main(test=False):
         exception = error
 
     finally:
+        if metrics is not None:
+            metrics.stop_reporting_progress()
+            export_metrics(metrics, metrics_file, prometheus_file)
+
+        if base_client is not None:
+            base_client.close()
+
+        # A shard whose migration failed still writes its summary, so the merge can report the error
+        if shard is not None and summary_file:
+            try:
+                write_shard_summary(summary_file, shard, namespace_results, exception)
+            except Exception as error:
+                output(logging.WARNING, f'Could not write the shard summary: {error}')
+
         if test and exception is not None:
             raise exception
 
@@ -254,15 +2316,34 @@ if __name__ == '__main__':
     # Specify the log file if necessary (append if already created)
     log_file_name = 'logfile.txt'
 
-    # Set up the logger
-    logging.basicConfig(filename=log_file_name, encoding='utf-8', level=level, datefmt='%Y-%m-%d %H:%M:%S', format= '%(asctime)s %(module)16s,line: %(lineno)4d %(levelname)8s | %(message)s')
+    # Set up the logger, which writes to the log file in batches on a background thread
+    log_pipeline = LogPipeline(log_file_name, level)
+
+    ## Command Line ##
+
+    # By default the single namespace in appsettings.json is migrated. Several namespaces can be migrated at once in worker processes
+    parser = argparse.ArgumentParser(description='Change the SDS Types of the streams matching the stream search pattern in appsettings.json')
+    parser.add_argument('mode', nargs='?', choices=['convert', 'plan', 'execute', 'watch', 'verify', 'merge'], default='convert',
+                        help='convert the streams in one pass (default), only write a migration plan, execute a migration plan, keep converting new streams as they appear, '
+                             'verify the types of the streams after a migration, or merge the summaries of the shards of a migration')
+    parser.add_argument('summary_files', nargs='*', metavar='SUMMARY_FILE', help='the shard summaries to combine in merge mode')
+    parser.add_argument('--plan-file', help='the migration plan file to write or execute, instead of the PlanFile in appsettings.json')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N', help='only convert the streams of shard i of N, to split the migration across N hosts')
+    parser.add_argument('--summary-file', help='the summary file to write for a shard, or the merged summary file to write in merge mode, instead of the ShardSummaryFile in appsettings.json')
+    namespace_group = parser.add_mutually_exclusive_group()
+    namespace_group.add_argument('--namespaces', nargs='+', metavar='NAMESPACE_ID', help='migrate each of these namespaces instead of the NamespaceId in appsettings.json')
+    namespace_group.add_argument('--all-namespaces', action='store_true', help='migrate every namespace of the tenant')
+    args = parser.parse_args()
+
     output(logging.INFO, 'Starting Stream Type change sample')
 
     try:
         # Run the sample
-        main()
+        main(namespace_ids=['*'] if args.all_namespaces else args.namespaces, mode=args.mode, plan_file=args.plan_file,
+             shard=args.shard, summary_file=args.summary_file, summary_files=args.summary_files)
     
         # No except block is necessary as exceptions will be logged by the sample itself
     finally:
         # Write a message that the logger is done.
         output(logging.INFO, 'Stream Type change sample completed')
+        log_pipeline.stop()
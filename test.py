@@ -1,8 +1,18 @@
 """This script tests the ADH Stream Type Change Python sample script"""
 
 import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
 import unittest
+from collections import Counter
+from unittest import mock
 
+import program
+from fake_adh import FakeADH
 from program import main
 from adh_sample_library_preview import ADHClient, SdsStream, SdsType, SdsTypeProperty, SdsTypeCode
 
@@ -178,5 +188,530 @@ class ADHStreamTypeChangePythonSampleTests(unittest.TestCase):
         assert exception is None, 'exception enountered during the test'
 
 
+class ADHStreamTypeChangePythonSampleFakeServiceTests(unittest.TestCase):
+    """Tests for the ADH Stream Type Change Python sample against the local fake ADH service"""
+
+    namespace_id = 'e2etest'
+    adapter_type = 'OpcUa'
+    stream_count = 250
+
+    def setUp(self):
+        """Creates a working directory for the local files written by the sample"""
+        working_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(working_directory.cleanup)
+        self.working_directory = working_directory.name
+
+    def start_fake(self, adapter_type=None, **options):
+        """Starts the fake ADH service with the given options, and seeds its namespace as it looks after an adapter upgrade"""
+        self.fake = FakeADH(**options).start()
+        self.addCleanup(self.fake.stop)
+        self.fake.seed_adapter_namespace(self.namespace_id, self.stream_count, adapter_type=adapter_type or self.adapter_type)
+        self.old_types = self.stream_types()
+        return self.fake
+
+    def stream_types(self):
+        """Returns the current type id of each stream of the namespace"""
+        return {stream['Id']: stream['TypeId'] for stream in self.fake.namespaces[self.namespace_id]['Streams'].values()}
+
+    def working_file(self, file_name):
+        """Returns the path of a file in the working directory"""
+        return os.path.join(self.working_directory, file_name)
+
+    def appsettings(self, **overrides):
+        """Returns the appsettings for the fake ADH service, with every local file of the sample in the working directory"""
+        return self.fake.appsettings(self.namespace_id, **{
+            'AdapterType': self.adapter_type,
+            'PageSize': 100,
+            'JournalFile': self.working_file('journal.jsonl'),
+            'FailedStreamsFile': self.working_file('failed_streams.jsonl'),
+            'PlanFile': self.working_file('migration_plan.jsonl'),
+            'VerificationReportFile': self.working_file('verification_report.json'),
+            'ShardSummaryFile': self.working_file('shard_summary.json'),
+            'StreamViewCacheFile': self.working_file('stream_view_cache.json'),
+            'MetricsFile': self.working_file('metrics.json'),
+            **overrides
+        })
+
+    def expected_type_id(self, old_type_id):
+        """Returns the type id a stream of the given existing type is expected to be converted to"""
+        return f'{old_type_id}.{self.adapter_type}Quality'
+
+    def assert_all_converted(self, stream_ids=None):
+        """Checks that the given streams (or every seeded stream) now have the correctly updated types"""
+        current_types = self.stream_types()
+        for stream_id in stream_ids if stream_ids is not None else self.old_types:
+            expected_new_type_id = self.expected_type_id(self.old_types[stream_id])
+            assert current_types[stream_id] == expected_new_type_id, f'type conversion failed for {stream_id}. expected type: {expected_new_type_id}, new type: {current_types[stream_id]}'
+
+    def test_main_against_fake_service(self):
+        """Tests that the main sample script converts every adapter stream on a namespace of the fake ADH service"""
+        self.start_fake()
+
+        main(True, self.appsettings())
+
+        self.assert_all_converted()
+
+    def test_resume_against_fake_service(self):
+        """Tests that a second run passes over the streams the journal records as converted, but converts a stream that went back to its existing type"""
+        fake = self.start_fake()
+        appsettings = self.appsettings()
+
+        main(True, appsettings)
+
+        # change one of the converted streams back to its existing type, as if it had been deleted and re-created by the adapter
+        reverted_stream_id = next(iter(self.old_types))
+        fake.namespaces[self.namespace_id]['Streams'][reverted_stream_id]['TypeId'] = self.old_types[reverted_stream_id]
+
+        main(True, appsettings)
+
+        # check that only the reverted stream was converted again
+        self.assert_all_converted()
+        assert len(fake.call_latencies['updateStreamType']) == len(self.old_types) + 1, 'the second run did not convert only the reverted stream'
+
+    def test_streaming_enumeration_against_fake_service(self):
+        """Tests that the Streaming enumeration mode converts every stream across several pages, and still reports a stream search pattern without any match"""
+        fake = self.start_fake()
+        appsettings = self.appsettings(EnumerationMode='Streaming')
+
+        main(True, appsettings)
+
+        # the streams span several pages, each of which is converted as it arrives
+        self.assert_all_converted()
+        assert len(fake.call_latencies['getStreams']) > len(self.old_types) // appsettings['PageSize'], 'the streams were not enumerated over several pages'
+
+        # with nothing to count up front, an empty search result is only found once the enumeration is done
+        with self.assertRaisesRegex(Exception, 'No stream found'):
+            main(True, dict(appsettings, StreamSearchPattern='NoSuchStream*'))
+
+    def test_stream_view_cache_against_fake_service(self):
+        """Tests that the stream view cache is not written while a stream view is missing, is regenerated once streams appear on new types,
+        and otherwise saves the type query"""
+        fake = self.start_fake()
+        appsettings = self.appsettings()
+
+        # the creation of the stream view for a new type without its existing type fails, so the cache must not be written
+        fake.add_type(self.namespace_id, f'TimeIndexed.Byte.{self.adapter_type}Quality')
+        main(True, appsettings)
+        self.assert_all_converted()
+        assert not os.path.exists(appsettings['StreamViewCacheFile']), 'the stream views were cached while one of them is missing'
+
+        # once the existing type and its streams appear, the next runs create the missing stream view and convert them
+        for types in (['TimeIndexed.Byte'], ['TimeIndexed.SByte', f'TimeIndexed.SByte.{self.adapter_type}Quality']):
+            for type_id in types:
+                fake.add_type(self.namespace_id, type_id)
+            new_stream_ids = [f'{types[0]}.{i}' for i in range(5)]
+            for stream_id in new_stream_ids:
+                fake.add_stream(self.namespace_id, stream_id, types[0])
+            self.old_types.update((stream_id, types[0]) for stream_id in new_stream_ids)
+
+            main(True, appsettings)
+            self.assert_all_converted(new_stream_ids)
+            assert os.path.exists(appsettings['StreamViewCacheFile']), 'the stream views were not cached once they were all in place'
+
+        # with nothing new on the namespace, the cached stream views are confirmed with one stream view query, without querying the types
+        type_queries = len(fake.call_latencies['getTypes'])
+        stream_view_queries = len(fake.call_latencies['getStreamViews'])
+        main(True, appsettings)
+        assert len(fake.call_latencies['getTypes']) == type_queries, 'the types were queried despite the cached stream views'
+        assert len(fake.call_latencies['getStreamViews']) == stream_view_queries + 1, 'the cached stream views were not confirmed with a single query'
+
+    def test_per_type_queries_against_fake_service(self):
+        """Tests that the PerType query strategy only fetches the streams of the existing types, and that ReportSkipped counts the others"""
+        fake = self.start_fake()
+        skipped_stream_count = 30
+        fake.add_type(self.namespace_id, 'Unmapped')
+        for i in range(skipped_stream_count):
+            fake.add_stream(self.namespace_id, f'{self.adapter_type}.unmapped.{i}', 'Unmapped')
+
+        with mock.patch('program.log_tally', wraps=program.log_tally) as log_tally:
+            main(True, self.appsettings(QueryStrategy='PerType', ReportSkipped=True))
+
+        self.assert_all_converted()
+        tally = log_tally.call_args.args[0]
+        assert tally['converted'] == len(self.old_types), f'expected {len(self.old_types)} converted streams, found {tally["converted"]}'
+        assert tally['skipped'] == skipped_stream_count, f'expected {skipped_stream_count} skipped streams, found {tally["skipped"]}'
+
+        assert len(fake.call_latencies['updateStreamType']) == len(self.old_types), 'a skipped stream was converted'
+
+        # the skipped streams are skipped again on every run, so only the conversions are journaled
+        with open(self.working_file('journal.jsonl')) as f:
+            journaled_outcomes = Counter(json.loads(line)['Outcome'] for line in f)
+        assert journaled_outcomes == Counter(converted=len(self.old_types)), f'unexpected journal entries: {journaled_outcomes}'
+
+        # each existing type fits in one page, so there is one query per existing type and one more for the skipped streams
+        existing_type_count = len(set(self.old_types.values()))
+        assert len(fake.call_latencies['getStreams']) == existing_type_count + 1, f'expected {existing_type_count + 1} stream queries, found {len(fake.call_latencies["getStreams"])}'
+
+    def test_expired_token_is_refreshed_inline(self):
+        """Tests that the pooled client requests a new token itself once the background refreshes failed until the token expired"""
+
+        class FakeAuthentication:
+            """Hands out numbered tokens valid for an hour, and only requests a new one within 5 minutes of expiring"""
+            def __init__(self, tenant, url, client_id, client_secret):
+                self.tokens = 0
+                self._Authentication__expiration = 0
+
+            def getToken(self):
+                if self._Authentication__expiration - time.time() <= 5 * 60:
+                    self.tokens += 1
+                    self._Authentication__expiration = time.time() + 3600
+                return f'token{self.tokens}'
+
+        with mock.patch.object(sys.modules['adh_sample_library_preview.BaseClient'], 'Authentication', FakeAuthentication):
+            base_client = program.PooledBaseClient('v1', 'tenant', 'https://localhost', 'client', 'secret', token_refresh_interval=3600)
+        self.addCleanup(base_client.close)
+
+        assert base_client._getToken() == 'token1', 'a valid token was not reused'
+
+        # let the token expire without the background thread having refreshed it
+        base_client._BaseClient__auth_object._Authentication__expiration = time.time() - 1
+        assert base_client._getToken() == 'token2', 'the expired token was not refreshed'
+
+    def test_missing_library_attribute_is_reported(self):
+        """Tests that the pooled client refuses to start when the library no longer has the private attributes it relies on"""
+
+        class FakeAuthentication:
+            """Hands out a token without tracking its expiry the way the pinned library version does"""
+            def __init__(self, tenant, url, client_id, client_secret):
+                pass
+
+            def getToken(self):
+                return 'token'
+
+        with mock.patch.object(sys.modules['adh_sample_library_preview.BaseClient'], 'Authentication', FakeAuthentication):
+            with self.assertRaisesRegex(Exception, '_Authentication__expiration'):
+                program.PooledBaseClient('v1', 'tenant', 'https://localhost', 'client', 'secret', token_refresh_interval=3600)
+
+    def test_plan_and_execute_against_fake_service(self):
+        """Tests that planning a migration makes no changes, that executing the plan converts every planned stream,
+        and that a stream converted before the plan but changed back to its existing type since is converted again"""
+        fake = self.start_fake()
+        appsettings = self.appsettings()
+
+        main(True, appsettings, mode='plan')
+
+        # check that planning left the namespace untouched, and that the plan covers every stream
+        assert len(fake.namespaces[self.namespace_id]['StreamViews']) == 0, 'stream views were created while planning'
+        assert self.stream_types() == self.old_types, 'streams were changed while planning'
+
+        with open(appsettings['PlanFile']) as f:
+            plan_header = json.loads(f.readline())
+        assert plan_header['Summary']['Convertible'] == len(self.old_types), 'the plan does not cover every stream'
+
+        main(True, appsettings, mode='execute')
+
+        self.assert_all_converted()
+
+        # change one of the converted streams back to its existing type, and plan again. The journal entry of its conversion predates the plan
+        reverted_stream_id = next(iter(self.old_types))
+        fake.namespaces[self.namespace_id]['Streams'][reverted_stream_id]['TypeId'] = self.old_types[reverted_stream_id]
+
+        main(True, appsettings, mode='plan')
+        main(True, appsettings, mode='execute')
+
+        self.assert_all_converted()
+        assert len(fake.call_latencies['updateStreamType']) == len(self.old_types) + 1, 'the reverted stream was not converted again'
+
+        # executing the same plan again trusts the journal entry recorded after the plan, rather than converting the stream again
+        main(True, appsettings, mode='execute')
+
+        assert len(fake.call_latencies['updateStreamType']) == len(self.old_types) + 1, 'a stream converted since the plan was written was converted again'
+        assert not os.path.exists(appsettings['FailedStreamsFile']), 'streams were written to the failed streams file'
+
+    def test_plan_file_closed_without_execution(self):
+        """Tests that the plan file is closed when its execution stops before any stream is converted,
+        whether the user chooses not to continue or the stream views cannot be provisioned"""
+        self.start_fake()
+        appsettings = self.appsettings()
+        main(True, appsettings, mode='plan')
+
+        opened_files = []
+        def tracking_open(*args, **kwargs):
+            opened_files.append(open(*args, **kwargs))
+            return opened_files[-1]
+
+        with mock.patch.object(program, 'open', tracking_open, create=True):
+            with mock.patch('builtins.input', return_value='n'):
+                assert program.execute_migration_plan(None, appsettings, appsettings['PlanFile'], False) == (None, None), 'the plan was executed'
+
+            # without a client, provisioning the stream views fails
+            with self.assertRaises(AttributeError):
+                program.execute_migration_plan(None, appsettings, appsettings['PlanFile'], True)
+
+        assert opened_files, 'the plan file was not read'
+        assert all(f.closed for f in opened_files), 'the plan file was left open'
+
+    def test_metrics_against_fake_service(self):
+        """Tests that the metrics file counts the calls served by the fake ADH service and the outcome of every stream,
+        that the Prometheus file is well formed, and that merging the metrics of another process adds them up"""
+        fake = self.start_fake()
+        appsettings = self.appsettings(PrometheusFile=self.working_file('metrics.prom'))
+
+        # keep the metrics of the run, to merge them afterwards
+        run_metrics = []
+        api_metrics = program.ApiMetrics
+        def create_metrics():
+            run_metrics.append(api_metrics())
+            return run_metrics[-1]
+
+        with mock.patch.object(program, 'ApiMetrics', create_metrics):
+            main(True, appsettings)
+
+        with open(appsettings['MetricsFile']) as f:
+            metrics = json.load(f)
+        assert metrics['Streams']['Outcomes'] == {'converted': len(self.old_types)}, f'unexpected outcomes: {metrics["Streams"]["Outcomes"]}'
+        for operation in ('getStreams', 'updateStreamType'):
+            call_metrics = metrics['Calls'][f'Streams.{operation}']
+            assert call_metrics['Count'] == len(fake.call_latencies[operation]), f'expected {len(fake.call_latencies[operation])} {operation} calls, found {call_metrics["Count"]}'
+            assert call_metrics['Errors'] == 0, f'{operation} errors were counted'
+            assert sum(call_metrics['Histogram'].values()) == call_metrics['Count'], f'the {operation} histogram does not add up to its count'
+
+        # every sample is of a metric whose type was declared, with well formed labels and a numeric value
+        sample_pattern = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="[^"]*"(,[a-zA-Z_][a-zA-Z0-9_]*="[^"]*")*\})? (\S+)')
+        declared_types = {}
+        samples = {}
+        with open(appsettings['PrometheusFile']) as f:
+            for line in f.read().splitlines():
+                if line.startswith('# TYPE '):
+                    name, metric_type = line.split()[2:]
+                    declared_types[name] = metric_type
+                elif not line.startswith('# HELP '):
+                    match = sample_pattern.fullmatch(line)
+                    assert match, f'malformed Prometheus line: {line}'
+                    histogram_name = re.sub(r'_(bucket|sum|count)$', '', match.group(1))
+                    assert match.group(1) in declared_types or declared_types.get(histogram_name) == 'histogram', f'the type of {match.group(1)} was not declared before its samples'
+                    samples[match.group(1) + (match.group(2) or '')] = float(match.group(4))
+        assert samples['stream_conversion_streams_total{outcome="converted"}'] == len(self.old_types), 'the converted streams were not exported'
+        assert samples['adh_client_call_duration_seconds_bucket{operation="Streams.updateStreamType",le="+Inf"}'] == len(fake.call_latencies['updateStreamType']), \
+            'the updateStreamType histogram does not cover every call'
+
+        # merging the metrics of the run twice, as for two namespace worker processes, doubles the counts
+        merged_metrics = program.ApiMetrics()
+        merged_metrics.merge(run_metrics[0].state())
+        merged_metrics.merge(run_metrics[0].state())
+        merged = merged_metrics.summary()
+        assert merged['Streams']['Outcomes'] == {'converted': 2 * len(self.old_types)}, f'unexpected merged outcomes: {merged["Streams"]["Outcomes"]}'
+        for operation, call_metrics in metrics['Calls'].items():
+            assert merged['Calls'][operation]['Count'] == 2 * call_metrics['Count'], f'the {operation} calls were not added up'
+            assert merged['Calls'][operation]['Histogram'] == {bucket: 2 * count for bucket, count in call_metrics['Histogram'].items()}, f'the {operation} histograms were not added up'
+
+    def test_main_against_throttling_fake_service(self):
+        """Tests that the main sample script converts every stream when the fake ADH service throttles the calls over its capacity"""
+        fake = self.start_fake(latency=0.01, max_in_flight=2, retry_after=0)
+
+        main(True, self.appsettings(MaxConcurrency=8, RetryBaseDelaySeconds=0.01, MaxRetries=10))
+
+        # check that the calls were throttled, but every stream still has the correctly updated type
+        assert fake.call_statuses['updateStreamType'][429] > 0, 'the fake service did not throttle any calls'
+        self.assert_all_converted()
+        assert not os.path.exists(self.working_file('failed_streams.jsonl')), 'streams were written to the failed streams file'
+
+    def test_main_against_lost_responses_fake_service(self):
+        """Tests that a stream whose type change was carried out, but whose response was lost, is counted as converted when the retry is refused"""
+        fake = self.start_fake(lost_response_rate=0.1, seed=1)
+        appsettings = self.appsettings(RetryBaseDelaySeconds=0.01, MaxRetries=10)
+
+        main(True, appsettings)
+
+        # check that some retries were refused because the earlier attempt had gone through, but no stream was reported as failed
+        assert fake.call_statuses['updateStreamType'][400] > 0, 'the fake service did not refuse any retried type change'
+        self.assert_all_converted()
+        assert not os.path.exists(appsettings['FailedStreamsFile']), 'streams were written to the failed streams file'
+
+        with open(appsettings['JournalFile']) as f:
+            journaled_outcomes = Counter(json.loads(line)['Outcome'] for line in f)
+        assert journaled_outcomes == Counter(converted=len(self.old_types)), f'unexpected journal entries: {journaled_outcomes}'
+
+    def test_main_against_jittery_fake_service(self):
+        """Tests that the spread of latencies of a fake ADH service that never throttles does not lower the concurrency limit"""
+        fake = self.start_fake(latency=0.005, latency_jitter=0.045)
+        concurrencies = []
+        real_create_adaptive_concurrency = program.create_adaptive_concurrency
+
+        def create_adaptive_concurrency(appsettings):
+            concurrency = real_create_adaptive_concurrency(appsettings)
+            concurrencies.append(concurrency)
+            return concurrency
+
+        with mock.patch('program.create_adaptive_concurrency', create_adaptive_concurrency):
+            main(True, self.appsettings(MaxConcurrency=8, LatencyTolerance=3.0))
+
+        assert sum(fake.call_statuses['updateStreamType'].values()) == len(self.old_types), 'not every stream was converted in one call'
+        self.assert_all_converted()
+        assert concurrencies, 'the adaptive concurrency limit was not used'
+        for concurrency in concurrencies:
+            assert concurrency.lowest_limit == concurrency.maximum, f'the concurrency limit went as low as {concurrency.lowest_limit} without any throttling'
+
+    def test_verify_against_fake_service(self):
+        """Tests that the verify mode reports every converted stream, and finds a stream that was changed back to its existing type"""
+        fake = self.start_fake()
+        appsettings = self.appsettings()
+
+        main(True, appsettings)
+
+        # change one of the converted streams back to its existing type
+        reverted_stream_id = next(iter(self.old_types))
+        fake.namespaces[self.namespace_id]['Streams'][reverted_stream_id]['TypeId'] = self.old_types[reverted_stream_id]
+
+        # the verify mode only reads the journal, so it must never open it to append
+        with mock.patch('program.open', wraps=open, create=True) as program_open:
+            main(True, appsettings, mode='verify')
+
+        journal_opens = [call for call in program_open.call_args_list if call.args and call.args[0] == appsettings['JournalFile']]
+        assert journal_opens, 'the verify mode did not read the journal'
+        assert all(call.args[1:2] == ('r',) for call in journal_opens), f'the verify mode opened the journal other than to read it: {journal_opens}'
+
+        with open(appsettings['VerificationReportFile']) as f:
+            report = json.load(f)
+        assert report['Summary']['Converted'] == len(self.old_types) - 1, f'expected {len(self.old_types) - 1} converted streams, found {report["Summary"]["Converted"]}'
+        assert report['Unchanged'][self.old_types[reverted_stream_id]]['StreamIds'] == [reverted_stream_id], 'the reverted stream was not reported as unchanged'
+
+    def test_watch_against_fake_service(self):
+        """Tests that the watch mode converts the streams that appear between its cycles, without converting the streams it has already seen again"""
+        fake = self.start_fake()
+        interval = 0.0125
+        new_stream_ids = [f'{self.adapter_type}.late.{i}' for i in range(20)]
+        real_sleep = time.sleep
+
+        def sleep(seconds):
+            """Creates the late streams during the first wait between cycles, as an adapter that has not been restarted would"""
+            if seconds == interval and new_stream_ids[0] not in fake.namespaces[self.namespace_id]['Streams']:
+                for stream_id in new_stream_ids:
+                    fake.add_stream(self.namespace_id, stream_id, 'TimeIndexed.Double')
+            real_sleep(seconds)
+
+        with mock.patch('time.sleep', sleep):
+            main(True, self.appsettings(WatchIntervalSeconds=interval, WatchMaxCycles=3), mode='watch')
+
+        # check that the late streams were converted as well, and that each stream was only converted once across the cycles
+        self.old_types.update((stream_id, 'TimeIndexed.Double') for stream_id in new_stream_ids)
+        self.assert_all_converted()
+        assert len(fake.call_latencies['updateStreamType']) == len(self.old_types), 'streams were converted more than once'
+
+    def test_mapping_rules_against_fake_service(self):
+        """Tests that the streams are converted as the sample mapping rules file says, for an adapter type the naming convention refuses"""
+        self.adapter_type = 'Dnp3'
+        fake = self.start_fake()
+        fake.add_type(self.namespace_id, 'TimeIndexed.Double.Dnp3AnalogQuality')
+        fake.add_type(self.namespace_id, 'TimeIndexed.BinaryCounter')
+        # the target of the catch-all rule exists too, so the counter stream is only left unconverted if the counter rule is applied first
+        fake.add_type(self.namespace_id, 'TimeIndexed.BinaryCounter.Dnp3Quality')
+        fake.add_stream(self.namespace_id, 'Dnp3.Counter', 'TimeIndexed.BinaryCounter')
+        self.old_types = self.stream_types()
+
+        main(True, self.appsettings(MappingRulesFile=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mapping_rules.sample.json')))
+
+        # check that each stream has the type given by the first rule that matches its existing type
+        current_types = self.stream_types()
+        for stream_id, old_type_id in self.old_types.items():
+            if old_type_id == 'TimeIndexed.BinaryCounter':
+                expected_new_type_id = old_type_id
+            elif old_type_id == 'TimeIndexed.Double':
+                expected_new_type_id = 'TimeIndexed.Double.Dnp3AnalogQuality'
+            else:
+                expected_new_type_id = self.expected_type_id(old_type_id)
+            assert current_types[stream_id] == expected_new_type_id, f'type conversion failed for {stream_id}. expected type: {expected_new_type_id}, new type: {current_types[stream_id]}'
+
+    def test_shards_against_fake_service(self):
+        """Tests that the shards of a migration together convert every stream exactly once, and that their summaries merge into the overall tally"""
+        fake = self.start_fake()
+        appsettings = self.appsettings()
+        shard_count = 3
+
+        summary_files = []
+        for index in range(1, shard_count + 1):
+            main(True, dict(appsettings, Shard=f'{index}/{shard_count}'))
+            summary_files.append(self.working_file(f'shard_summary.{index}of{shard_count}.json'))
+
+        # check that each stream was converted by one shard only
+        self.assert_all_converted()
+        assert len(fake.call_latencies['updateStreamType']) == len(self.old_types), 'streams were converted by more than one shard'
+
+        main(True, appsettings, mode='merge', summary_files=summary_files)
+
+        with open(appsettings['ShardSummaryFile']) as f:
+            merged_summary = json.load(f)
+        assert merged_summary['Tally']['converted'] == len(self.old_types), f'expected {len(self.old_types)} converted streams, found {merged_summary["Tally"]["converted"]}'
+        assert merged_summary['MissingShards'] == [], f'shards reported missing: {merged_summary["MissingShards"]}'
+
+    def test_merge_from_command_line(self):
+        """Tests that the merge mode writes to the ShardSummaryFile of appsettings.json when run without settings, as from the command line,
+        and that it exits with an error status when there is nothing to merge"""
+        current_directory = os.getcwd()
+        os.chdir(self.working_directory)
+        self.addCleanup(os.chdir, current_directory)
+
+        with open('appsettings.json', 'w') as f:
+            json.dump({'ShardSummaryFile': 'merged_summary.json'}, f)
+        program.write_shard_summary('shard_summary.1of1.json', program.Shard(1, 1), {self.namespace_id: ({'converted': 3}, None)})
+
+        main(mode='merge', summary_files=['shard_summary.1of1.json'])
+
+        with open('merged_summary.json') as f:
+            assert json.load(f)['Tally']['converted'] == 3, 'the summary was not merged into the ShardSummaryFile of appsettings.json'
+
+        with self.assertRaises(SystemExit) as context:
+            main(mode='merge', summary_files=[])
+        assert context.exception.code == 1, f'expected an exit status of 1, found {context.exception.code}'
+
+    def test_fan_out_against_fake_service(self):
+        """Tests that several namespaces are migrated in spawned worker processes, each with its own journal and stream view cache, and that their tallies add up"""
+        fake = self.start_fake()
+        namespace_ids = [self.namespace_id, 'e2etest2']
+        fake.seed_adapter_namespace(namespace_ids[1], 100, adapter_type=self.adapter_type)
+        appsettings = self.appsettings(MaxNamespaceWorkers=2)
+
+        with mock.patch('program.fan_out_namespaces', wraps=program.fan_out_namespaces) as fan_out_namespaces, \
+             mock.patch('program.ProcessPoolExecutor', wraps=program.ProcessPoolExecutor) as process_pool_executor:
+            main(True, appsettings, namespace_ids=namespace_ids)
+
+        assert process_pool_executor.call_args.kwargs['mp_context'].get_start_method() == 'spawn', 'the worker processes were not spawned'
+
+        # check that every stream of each namespace was converted, and that the tally of each namespace was reported
+        self.assert_all_converted()
+        namespace_results = fan_out_namespaces.call_args.args[5]
+        for namespace_id in namespace_ids:
+            stream_count = len(fake.namespaces[namespace_id]['Streams'])
+            assert all(stream['TypeId'].endswith(f'.{self.adapter_type}Quality') for stream in fake.namespaces[namespace_id]['Streams'].values()), f'not every stream of {namespace_id} was converted'
+
+            tally, error = namespace_results[namespace_id]
+            assert error is None, f'namespace {namespace_id} reported an error: {error}'
+            assert tally['converted'] == stream_count, f'expected {stream_count} converted streams on {namespace_id}, found {tally["converted"]}'
+
+            # each namespace has its own journal and stream view cache, named after the configured files
+            with open(self.working_file(f'journal.{namespace_id}.jsonl')) as f:
+                journaled_stream_ids = {json.loads(line)['StreamId'] for line in f}
+            assert journaled_stream_ids == set(fake.namespaces[namespace_id]['Streams']), f'the journal of {namespace_id} does not hold its streams'
+            with open(self.working_file(f'stream_view_cache.{namespace_id}.json')) as f:
+                assert len(json.load(f)) == 1, f'the stream view cache of {namespace_id} does not hold its stream views'
+
+        # the metrics of the worker processes are merged into the overall outcomes
+        with open(appsettings['MetricsFile']) as f:
+            outcomes = json.load(f)['Streams']['Outcomes']
+        total_stream_count = sum(len(fake.namespaces[namespace_id]['Streams']) for namespace_id in namespace_ids)
+        assert outcomes['converted'] == total_stream_count, f'expected {total_stream_count} converted streams in the metrics, found {outcomes["converted"]}'
+
+    def test_log_pipeline_flushes_while_idle(self):
+        """Tests that the logging pipeline writes out a partial batch once its flush interval has passed, without waiting for another record"""
+        root_logger = logging.getLogger()
+        self.addCleanup(setattr, root_logger, 'handlers', list(root_logger.handlers))
+        self.addCleanup(root_logger.setLevel, root_logger.level)
+
+        log_file_name = self.working_file('logfile.txt')
+        log_pipeline = program.LogPipeline(log_file_name, logging.INFO, flush_interval=0.05)
+        self.addCleanup(log_pipeline.stop)
+
+        logging.info('the last record before a quiet spell')
+
+        # no other record arrives, so only the periodic flush can write it out
+        deadline = time.monotonic() + 5
+        contents = ''
+        while 'quiet spell' not in contents and time.monotonic() < deadline:
+            time.sleep(0.05)
+            with open(log_file_name, encoding='utf-8') as f:
+                contents = f.read()
+        assert 'quiet spell' in contents, 'the record was not written to the log file while the pipeline was idle'
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file